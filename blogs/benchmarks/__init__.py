@@ -0,0 +1,35 @@
+from statistics import median
+import time
+
+
+# Benchmarks register themselves by name, see the benchmark management command
+registry = {}
+
+
+def benchmark(name):
+    def register(func):
+        registry[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat=5, setup=None):
+    """Run func repeat times and return timings in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'runs': repeat,
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(median(timings), 3),
+        'max_ms': round(max(timings), 3),
+    }
+
+
+def speedup(before, after):
+    return round(before['median_ms'] / after['median_ms'], 1) if after['median_ms'] else None
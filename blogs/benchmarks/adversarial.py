@@ -0,0 +1,142 @@
+from django.contrib.auth.models import User
+from django.test import override_settings
+
+from blogs import render_sandbox
+from blogs.benchmarks import benchmark
+from blogs.helpers import unmark
+from blogs.models import Blog, Post, UserSettings
+from blogs.templatetags import custom_tags
+
+import multiprocessing
+import time
+
+
+MB = 1024 * 1024
+
+
+# Regex-hostile and size-extreme inputs, most of them around the 1MB post limit
+def corpus():
+    return {
+        'nested_brackets': '[' * 50000 + 'x' + ']' * 50000,
+        'unclosed_brackets': '[' * 100000,
+        'unclosed_links': '[a](https://example.com/(' * 20000,
+        'nested_parentheses': '[a](https://example.com/' + '(' * 50000 + ')' * 50000 + ')',
+        'unterminated_display_math': '$$' + 'x + y = z ' * 100000,
+        'unterminated_inline_math': '$$x' * 100000,
+        'dollars': '$' * 200000,
+        'code_spans': '<code>x</code> and `y` ' * 20000,
+        'unclosed_code': '<code>x ' * 50000,
+        'unclosed_pre': '<pre>' * 50000,
+        'backticks': '`' * 200000,
+        'single_line': 'word *emphasis* _more_ [link](https://example.com) ' * (MB // 53),
+        'emphasis_markers': '*_' * 200000,
+        'huge_table': '| a | b | c |\n|---|---|---|\n' + '| 1 | 2 | 3 |\n' * 50000,
+        'table_pipes': '|' * 200000,
+        'unclosed_tags': '<a href="x" ' * 50000,
+        'angle_brackets': '<' * 200000,
+        'comment_starts': '<!--' * 100000,
+        'script_starts': '<script>' * 50000,
+        'iframes': '<iframe src="https://evil.example.com/x">' * 30000,
+        'nested_iframes': '<iframe src="https://www.youtube.com/embed/x">' * 30000,
+        'event_handlers': '<b onclick=x ' * 50000,
+        'images': '![' * 100000,
+        'headings': '#' * 200000,
+        'blockquotes': '> ' * 200000,
+        'list_items': '- ' * 200000,
+        'directives': '{{ blog_title }} {{ ' * 50000,
+        'posts_directives': '{{ posts' * 50000,
+    }
+
+
+def benchmark_blog():
+    # Unsaved so rendering doesn't touch the database
+    user = User(username='benchmark')
+    user.settings = UserSettings(upgraded=False)
+    return Blog(user=user, title='Benchmark', subdomain='benchmark', lang='en')
+
+
+# Per input time budgets in milliseconds
+BUDGETS = {
+    'fix_links': 250,
+    'replace_inline_latex': 250,
+    'unmark': 1000,
+    'clean': 1000,
+    'excluding_pre': 500,
+    'markdown': 8000,
+}
+
+
+def functions():
+    blog = benchmark_blog()
+    post = Post(blog=blog, title='Benchmark', slug='benchmark', is_page=False)
+    return {
+        'fix_links': custom_tags.fix_links,
+        'replace_inline_latex': custom_tags.replace_inline_latex,
+        'unmark': unmark,
+        'clean': custom_tags.clean,
+        # With a directive, so it doesn't return straight away
+        'excluding_pre': lambda content: custom_tags.excluding_pre('{{ blog_title }}' + content, blog, post),
+        'markdown': lambda content: sandboxed_markdown(content, blog, post),
+    }
+
+
+def sandboxed_markdown(content, blog, post):
+    # The full render path, where content mistune itself is slow on goes to the sandbox
+    with override_settings(RENDER_SANDBOX=True):
+        return custom_tags.markdown(content, blog, post)
+
+
+def timed_run(connection, function, content):
+    start = time.perf_counter()
+    function(content)
+    elapsed = (time.perf_counter() - start) * 1000
+    # Stop the sandbox a sandboxed case started, before the parent kills this child
+    render_sandbox.reset_pool()
+    connection.send(elapsed)
+    connection.close()
+
+
+def run_case(function, content, timeout):
+    """
+    Times function(content) in a forked child, so every case starts with cold caches
+    and catastrophic backtracking, which can take minutes, can be killed.
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=timed_run, args=(sender, function, content))
+    process.start()
+    sender.close()
+
+    elapsed = None
+    if receiver.poll(timeout):
+        try:
+            elapsed = round(receiver.recv(), 3)
+        except EOFError:
+            # The child crashed
+            pass
+    process.kill()
+    process.join()
+    return elapsed
+
+
+@benchmark('adversarial')
+def adversarial(repeat=1):
+    inputs = corpus()
+    results = {}
+    failures = []
+    for function_name, function in functions().items():
+        budget = BUDGETS[function_name]
+        results[function_name] = {}
+        for input_name, content in inputs.items():
+            # Give up well past the budget so a hang doesn't stall the whole run
+            elapsed = run_case(function, content, timeout=max(budget * 4, 5000) / 1000)
+            results[function_name][input_name] = {'ms': elapsed, 'budget_ms': budget}
+
+            if elapsed is None or elapsed > budget:
+                failures.append(f'{function_name}({input_name})')
+
+    return {
+        'input_sizes': {name: len(content) for name, content in inputs.items()},
+        'results': results,
+        'failures': failures,
+    }
@@ -0,0 +1,86 @@
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from blogs.benchmarks import benchmark, measure, speedup
+from blogs.models import Blog, UserSettings
+
+import re
+
+
+def seed(blogs=5000):
+    users = User.objects.bulk_create([User(username=f'lookup{i}', email=f'lookup{i}@example.com') for i in range(blogs)])
+    UserSettings.objects.bulk_create([UserSettings(user=user) for user in users])
+    Blog.objects.bulk_create([
+        Blog(
+            user=user,
+            title=f'Blog {i}',
+            subdomain=f'lookup{i}',
+            # Stored the way people type them, which is what the iexact lookups were for
+            domain=f'www.Lookup{i}.com' if i % 2 else f'lookup{i}.com',
+            normalized_domain=f'lookup{i}.com',
+        )
+        for i, user in enumerate(users)
+    ])
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE blogs_blog')
+
+
+# An index search of the blog table, 'SEARCH blogs_blog USING INDEX ...' in SQLite, and in Postgres
+# 'Index Scan using blogs_blog_subdomain_key on blogs_blog' or 'Bitmap Index Scan on blogs_blog_...'
+INDEX_SEARCH = re.compile(r'SEARCH blogs_blog USING (?:COVERING )?INDEX|Index (?:Only )?Scan using \w+ on blogs_blog\b|Bitmap Index Scan on blogs_blog_')
+
+
+def uses_index(plan):
+    return INDEX_SEARCH.search(plan) is not None
+
+
+def query_plan(queryset):
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # The planner may still prefer a scan on a small table, this only asks whether the index can be used
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+
+def lookups():
+    blogs = Blog.objects.select_related('user').select_related('user__settings')
+    return {
+        'subdomain': lambda: blogs.filter(subdomain='lookup2500', user__is_active=True),
+        'domain': lambda: blogs.filter(normalized_domain='lookup2501.com', user__is_active=True),
+        # What they replaced, for comparison
+        'legacy_subdomain': lambda: blogs.filter(subdomain__iexact='Lookup2500', user__is_active=True),
+        'legacy_domain': lambda: blogs.filter(domain__iexact='www.lookup2501.com', user__is_active=True),
+    }
+
+
+@benchmark('lookups')
+def lookup_benchmark(repeat=5):
+    """
+    Checks that blog lookups by host are index searches, on whichever database is
+    configured, and times them against the iexact lookups they replaced.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        seed()
+        results = {}
+        failures = []
+        for name, queryset in lookups().items():
+            plan = query_plan(queryset())
+
+            results[name] = {
+                'plan': plan.splitlines(),
+                'uses_index': uses_index(plan),
+                **measure(lambda: queryset().first(), repeat=repeat * 20),
+            }
+            if not name.startswith('legacy_') and not results[name]['uses_index']:
+                failures.append(f'{name} lookup scans blogs_blog')
+
+        results['speedup'] = {
+            'subdomain': speedup(results['legacy_subdomain'], results['subdomain']),
+            'domain': speedup(results['legacy_domain'], results['domain']),
+        }
+        return {'vendor': connection.vendor, 'results': results, 'failures': failures}
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
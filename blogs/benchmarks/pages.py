@@ -0,0 +1,196 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from blogs.benchmarks import benchmark
+from blogs.models import Blog, BlogTag, Post
+
+from datetime import timedelta
+from unittest import mock
+import itertools
+import json
+import os
+import time
+import tracemalloc
+
+
+SUBDOMAIN = 'benchmark'
+
+# Requests timed per page for each repeat
+REQUESTS_PER_REPEAT = 20
+
+# Extra requests per page with allocation tracing on, which is too slow to time
+ALLOCATION_REQUESTS = 5
+
+
+def post_content(i):
+    # Around 8KB of the markdown posts are made of: prose, a list, code, math and a posts directive
+    paragraph = (
+        f"This is paragraph text for post {i}, with **bold**, _emphasis_, `inline code` and "
+        f"[a link](https://example.com/{i}/). It goes on for a while, as posts do, to give the "
+        "renderer and sanitizer a realistic amount of prose to work through.\n\n"
+    )
+    code = (
+        "```python\n"
+        f"def fibonacci_{i}(n):\n"
+        "    a, b = 0, 1\n"
+        "    for _ in range(n):\n"
+        "        a, b = b, a + b\n"
+        "    return a\n"
+        "```\n\n"
+    )
+    math = (
+        f"Inline math like $x_{{{i}}} = \\frac{{a + b}}{{2}}$ and a display formula:\n\n"
+        f"$$\n\\sum_{{k=0}}^{{{i}}} k = \\frac{{{i}({i} + 1)}}{{2}}\n$$\n\n"
+    )
+    listing = "".join(f"- Item {n} of the list in post {i}\n" for n in range(8)) + "\n"
+    image = f"![An image](https://example.com/images/{i}.png)\n\n"
+
+    content = f"# Post {i}\n\n" + paragraph * 6 + code + math + listing + image + paragraph * 6 + code + math
+    if i % 5 == 0:
+        content += "## Related\n\n{{ posts limit:5 }}\n"
+    return content
+
+
+def seed(posts=50):
+    """
+    Creates a blog with posts of realistic size. Bulk created so seeding doesn't
+    purge caches or render anything, which is left to the first request.
+    """
+    user = User.objects.create_user(username=SUBDOMAIN, email=f'{SUBDOMAIN}@example.com')
+    # The free tier, so the sanitizer runs too
+    user.settings.upgraded = False
+    user.settings.save()
+
+    Blog.objects.bulk_create([Blog(
+        user=user,
+        title='Benchmark',
+        subdomain=SUBDOMAIN,
+        content="# Hello\n\nA synthetic blog for benchmarks.\n\n{{ posts limit:10 }}\n",
+        custom_styles='body { font-family: sans-serif; }',
+    )])
+    blog = Blog.objects.get(subdomain=SUBDOMAIN)
+
+    now = timezone.now()
+    Post.objects.bulk_create([
+        Post(
+            blog=blog,
+            uid=f'benchmark{i}',
+            title=f'Post {i}',
+            slug=f'post-{i}',
+            published_date=now - timedelta(days=i),
+            first_published_at=now - timedelta(days=i),
+            all_tags=json.dumps([f'tag{i % 7}', 'benchmark']),
+            content=post_content(i),
+        )
+        for i in range(posts)
+    ])
+
+    # Bulk created posts aren't counted as they're saved
+    BlogTag.rebuild(blog)
+    blog.update_all_tags()
+    Blog.objects.filter(pk=blog.pk).update(all_tags=blog.all_tags, all_tools=blog.all_tools)
+    return blog
+
+
+def pages(blog):
+    return {
+        'home': '/',
+        'posts': f'/{blog.blog_path}/',
+        'post': '/post-1/',
+        'feed': '/feed.xml',
+        'sitemap': '/sitemap.xml',
+    }
+
+
+def percentile(timings, p):
+    # Nearest rank
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def page_request(client, path, n, **headers):
+    # A different address per request so the rate limiter doesn't kick in, accepting what browsers accept
+    headers.setdefault('HTTP_ACCEPT_ENCODING', 'gzip, deflate, br')
+    return client.get(path, HTTP_HOST=f"{SUBDOMAIN}.{os.getenv('MAIN_SITE_HOSTS').split(',')[0]}", REMOTE_ADDR=f'10.0.{n // 256 % 256}.{n % 256}', **headers)
+
+
+def measure_page(client, path, requests, revalidate=False):
+    counter = itertools.count()
+
+    # The first request renders and stores the markdown
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        response = page_request(client, path, next(counter))
+        cold_ms = (time.perf_counter() - start) * 1000
+    if response.status_code != 200:
+        raise Exception(f'{path} returned {response.status_code}')
+    cold_queries = len(queries)
+
+    # Feed readers and browsers asking whether what they have is still current
+    headers = {'HTTP_IF_NONE_MATCH': response['ETag']} if revalidate else {}
+    if revalidate and page_request(client, path, next(counter), **headers).status_code != 304:
+        raise Exception(f'{path} was not revalidated')
+
+    timings = []
+    with CaptureQueriesContext(connection) as queries:
+        cpu_start = time.process_time()
+        for _ in range(requests):
+            start = time.perf_counter()
+            page_request(client, path, next(counter), **headers)
+            timings.append((time.perf_counter() - start) * 1000)
+        cpu_ms = (time.process_time() - cpu_start) * 1000 / requests
+    warm_queries = len(queries) / requests
+
+    peaks, retained = [], []
+    for _ in range(ALLOCATION_REQUESTS):
+        tracemalloc.start()
+        try:
+            page_request(client, path, next(counter), **headers)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peaks.append(peak)
+        retained.append(current)
+
+    return {
+        'bytes': len(response.content),
+        'encoding': response.get('Content-Encoding', 'identity'),
+        'cold_ms': round(cold_ms, 3),
+        'cold_queries': cold_queries,
+        'requests': requests,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p90_ms': round(percentile(timings, 90), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'max_ms': round(max(timings), 3),
+        'cpu_ms': round(cpu_ms, 3),
+        'queries': round(warm_queries, 2),
+        'peak_allocated_kb': round(percentile(peaks, 50) / 1024, 1),
+        'retained_kb': round(percentile(retained, 50) / 1024, 1),
+    }
+
+
+@benchmark('pages')
+def page_benchmark(repeat=5):
+    """
+    Times the public blog pages through the test client against a throwaway
+    test database, so it's safe to run anywhere the app is configured.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        blog = seed()
+        client = Client()
+        results = {}
+        # Rendered on every request, served from the page cache, then answered with 304s
+        for variant, page_cache, revalidate in (('rendered', False, False), ('cached', True, False), ('revalidated', True, True)):
+            # Validators are only sent with a shared page version. In one process the local cache is shared.
+            with override_settings(PAGE_CACHE=page_cache), mock.patch('blogs.page_cache.shared_cache_enabled', return_value=True):
+                results[variant] = {
+                    name: measure_page(client, path, repeat * REQUESTS_PER_REPEAT, revalidate)
+                    for name, path in pages(blog).items()
+                }
+        return results
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
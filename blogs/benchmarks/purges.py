@@ -0,0 +1,135 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from blogs import cloudflare
+from blogs.benchmarks import benchmark, measure
+from blogs.models import Blog, Comment, Post, UserSettings
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import json
+import os
+import threading
+import time
+
+
+# How long the stub takes to answer, about what Cloudflare's purge API takes
+STUB_LATENCY = 0.2
+
+
+class StubPurgeServer(ThreadingHTTPServer):
+    """Stands in for Cloudflare's purge endpoint, recording the tags of every request"""
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubPurgeHandler)
+        self.requests = []
+        self.fail_next = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/client/v4'
+
+    def purged(self):
+        return {tag for tags in self.requests for tag in tags}
+
+
+class StubPurgeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(STUB_LATENCY)
+
+        status = 200
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            status = 500
+        else:
+            self.server.requests.append(body['tags'])
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'success': status == 200}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def seed(blogs=40):
+    users = User.objects.bulk_create([User(username=f'purge{i}', email=f'purge{i}@example.com') for i in range(blogs)])
+    UserSettings.objects.bulk_create([UserSettings(user=user) for user in users])
+    Blog.objects.bulk_create([Blog(user=user, title=f'Blog {i}', subdomain=f'purge{i}', custom_styles='body { font-family: sans-serif; }') for i, user in enumerate(users)])
+    Post.objects.bulk_create([
+        Post(blog=blog, uid=f'purge{blog.pk}', title='Post', slug='post', content='Hello', published_date=timezone.now())
+        for blog in Blog.objects.filter(subdomain__startswith='purge')
+    ])
+    return list(Post.objects.filter(uid__startswith='purge').select_related('blog'))
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+@benchmark('purges')
+def purge_benchmark(repeat=5):
+    """
+    Comments on posts across many blogs with Cloudflare purges pointed at a local stub,
+    checking saves don't wait on it and purges are coalesced into batches it accepts.
+    """
+    server = StubPurgeServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    environment = {
+        'ENVIRONMENT': 'benchmark',
+        'CLOUDFLARE_API_URL': server.url,
+        'CLOUDFLARE_API_KEY': 'key',
+        'CLOUDFLARE_EMAIL': 'benchmark@example.com',
+        'CLOUDFLARE_ZONE_ID': 'zone',
+    }
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with mock.patch.dict(os.environ, environment):
+            posts = seed()
+            failures = []
+            def comment(post):
+                Comment(post=post, user_id=post.blog.user_id, content='Hello').save()
+
+            # Every post a few times, so each blog is saved over and over within the window
+            queued = measure(lambda: [comment(post) for post in posts], repeat=repeat)
+            # Comments only purge the post's page, not the whole blog
+            tags = {cloudflare.post_tag(post.blog_id, post.pk) for post in posts}
+            if not wait_for(lambda: tags <= server.purged(), timeout=cloudflare.PURGE_WINDOW * 5):
+                failures.append('queued purges were not sent')
+            requests = list(server.requests)
+            if server.purged() != tags:
+                failures.append('comments purged more than their pages')
+
+            # What every save did before, a request to Cloudflare inline
+            synchronous = measure(lambda: [(comment(post), cloudflare.purge_tags([post.blog.subdomain])) for post in posts[:5]], repeat=1)
+
+            # A purge Cloudflare turns down is retried on the next flush
+            sent = len(server.requests)
+            server.fail_next = 1
+            posts[0].blog.invalidate_cloudflare_cache()
+            if not wait_for(lambda: any(posts[0].blog.subdomain in batch for batch in server.requests[sent:]), timeout=cloudflare.PURGE_WINDOW * 5):
+                failures.append('failed purge was not retried')
+
+        if any(len(batch) > cloudflare.MAX_TAGS_PER_PURGE for batch in requests):
+            failures.append(f'purge requests over {cloudflare.MAX_TAGS_PER_PURGE} tags')
+
+        saves = len(posts) * repeat
+        return {
+            'blogs': len(posts),
+            'tags': len(tags),
+            'saves': saves,
+            'queued_save_ms': round(queued['median_ms'] / len(posts), 3),
+            'synchronous_save_ms': round(synchronous['median_ms'] / 5, 3),
+            'purge_requests': len(requests),
+            'tags_per_request': [len(batch) for batch in requests],
+            'failures': failures,
+        }
+    finally:
+        server.shutdown()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
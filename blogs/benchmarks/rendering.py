@@ -0,0 +1,138 @@
+import re
+
+from blogs.benchmarks import benchmark, measure, speedup
+from blogs.models import Blog
+from blogs.sanitizer import HOST_WHITELIST, sanitize
+from blogs.templatetags import custom_tags
+
+
+def math_heavy_post(formulas=300):
+    paragraphs = []
+    for i in range(formulas):
+        # Some formulas repeat, as they do in real posts
+        n = i % (formulas // 3)
+        paragraphs.append(
+            f"Given $x_{{{n}}} = \\frac{{a_{n} + b}}{{\\sqrt{{c^2 + {n}}}}}$ it follows that\n\n"
+            f"$$\n\\sum_{{k=0}}^{{{n}}} \\binom{{{n}}}{{k}} x^k = \\int_0^1 (1 + x)^{{{n}}} \\, dx\n$$"
+        )
+    return "\n\n".join(paragraphs)
+
+
+@benchmark('math')
+def math(repeat=5):
+    content = math_heavy_post()
+    renderer = custom_tags.create_post_aware_markdown()
+
+    # Measure this worker only
+    shared = custom_tags.mathml_cache.shared
+    custom_tags.mathml_cache.shared = False
+    try:
+        cold = measure(lambda: renderer(content), repeat=repeat, setup=custom_tags.mathml_cache.clear)
+        renderer(content)
+        warm = measure(lambda: renderer(content), repeat=repeat)
+    finally:
+        custom_tags.mathml_cache.shared = shared
+
+    return {
+        'content_bytes': len(content),
+        'uncached': cold,
+        'cached': warm,
+        'speedup': speedup(cold, warm),
+    }
+
+
+def legacy_clean(markup):
+    # The regex chain clean() used before the single pass sanitizer, kept for comparison
+    cleaned_markup = re.sub(r'<script.*?>.*?</script>', '', markup, flags=re.DOTALL | re.IGNORECASE)
+    cleaned_markup = re.sub(r'\son\w+="[^"]*"', '', cleaned_markup, flags=re.IGNORECASE)
+    cleaned_markup = re.sub(r'\son\w+=\'[^\']*\'', '', cleaned_markup, flags=re.IGNORECASE)
+    cleaned_markup = re.sub(r'\son\w+=\w+', '', cleaned_markup, flags=re.IGNORECASE)
+    cleaned_markup = re.sub(r'(<\w+\s+.*?)(href|src)\s*=\s*["\']?javascript:[^"\']*["\']?', r'\1', cleaned_markup, flags=re.IGNORECASE)
+    cleaned_markup = re.sub(r'<(object|embed|form|input|button).*?>', '', cleaned_markup, flags=re.IGNORECASE)
+    cleaned_markup = re.sub(r'</(object|embed|form|input|button)>', '', cleaned_markup, flags=re.IGNORECASE)
+
+    def iframe_whitelisted(match):
+        src = match.group(2)
+        if any(host in src for host in HOST_WHITELIST):
+            return match.group(0)
+        return ''
+
+    return re.sub(r'(<iframe.*?src=["\'])([^"\']*)(["\'].*?>.*?</iframe>)', iframe_whitelisted, cleaned_markup, flags=re.DOTALL | re.IGNORECASE)
+
+
+def html_heavy_post(size=1024 * 1024):
+    block = (
+        '<h2 id="section">A section</h2>\n'
+        '<p>Some <strong>bold</strong> text with <a href="https://example.com/page" title="a link">a link</a> '
+        'and an <img src="/static/image.png" alt="an image" loading="lazy">.</p>\n'
+        '<pre class="highlight"><code><span class="k">def</span> <span class="nf">function</span>():</code></pre>\n'
+        '<iframe src="https://www.youtube.com/embed/abc" allowfullscreen></iframe>\n'
+        '<ul><li>one</li><li>two</li><li>three</li></ul>\n'
+        '<button onclick="alert(1)">Click</button><script>alert(1)</script>\n'
+    )
+    return block * (size // len(block))
+
+
+@benchmark('clean')
+def clean(repeat=5):
+    results = {}
+    # Markdown keeps a paragraph on one line, where the regex chain's .*? patterns rescan the rest of the line for every tag
+    for variant, markup in (('multi_line', html_heavy_post()), ('single_line', html_heavy_post(256 * 1024).replace('\n', ' '))):
+        legacy = measure(lambda: legacy_clean(markup), repeat=repeat)
+        single_pass = measure(lambda: sanitize(markup), repeat=repeat)
+        results[variant] = {
+            'content_bytes': len(markup),
+            'regex_chain': legacy,
+            'single_pass': single_pass,
+            'speedup': speedup(legacy, single_pass),
+        }
+    return results
+
+
+def legacy_excluding_pre(markup, blog, post=None, tz=None):
+    # excluding_pre before it was segment based, kept for comparison
+    placeholders = {}
+
+    def placeholder_div(match):
+        key = f"PLACEHOLDER_{len(placeholders)}"
+        placeholders[key] = match.group(0)
+        return key
+
+    markup = re.sub(r'(<pre.*?>.*?</pre>|<code.*?>.*?</code>)', placeholder_div, markup, flags=re.DOTALL)
+    markup = custom_tags.element_replacement(markup, blog, post, tz=tz)
+
+    for key in sorted(placeholders.keys(), reverse=True):
+        markup = markup.replace(key, placeholders[key])
+
+    return markup
+
+
+def code_heavy_markup(spans=500):
+    paragraphs = []
+    for i in range(spans):
+        paragraphs.append(
+            f"<p>Step {i} of {{{{ blog_title }}}}: call <code>function_{i}()</code> and compare with <code>{{{{ blog_title }}}}</code></p>\n"
+            f'<pre class="highlight"><code>value_{i} = compute({i})  # {{{{ blog_link }}}} stays literal</code></pre>'
+        )
+    return "\n".join(paragraphs)
+
+
+@benchmark('excluding_pre')
+def excluding_pre(repeat=5):
+    blog = Blog(title='Benchmark', subdomain='benchmark', lang='en')
+    markup = code_heavy_markup()
+    legacy = measure(lambda: legacy_excluding_pre(markup, blog), repeat=repeat)
+    segmented = measure(lambda: custom_tags.excluding_pre(markup, blog), repeat=repeat)
+
+    failures = []
+    if legacy_excluding_pre(markup, blog) != custom_tags.excluding_pre(markup, blog):
+        failures.append('segments render differently from placeholders')
+
+    return {
+        'content_bytes': len(markup),
+        'code_blocks': len(custom_tags.split_blocks(markup, ('pre', 'code'))) // 2,
+        'placeholders': legacy,
+        'segments': segmented,
+        'speedup': speedup(legacy, segmented),
+        'failures': failures,
+    }
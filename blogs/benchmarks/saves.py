@@ -0,0 +1,72 @@
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from blogs.benchmarks import benchmark
+from blogs.models import Blog, Post, UserSettings, batched_blog_updates
+
+from contextlib import nullcontext
+import time
+
+
+SAVES = 20
+
+
+def seed(blogs=3, posts=SAVES):
+    users = User.objects.bulk_create([User(username=f'saves{i}', email=f'saves{i}@example.com') for i in range(blogs)])
+    UserSettings.objects.bulk_create([UserSettings(user=user) for user in users])
+    Blog.objects.bulk_create([Blog(user=user, title=f'Blog {i}', subdomain=f'saves{i}', custom_styles='body { font-family: sans-serif; }') for i, user in enumerate(users)])
+    Post.objects.bulk_create([
+        Post(blog=blog, uid=f'saves{blog.pk}-{i}', title=f'Post {i}', slug=f'post-{i}', content='Hello', published_date=timezone.now())
+        for blog in Blog.objects.filter(subdomain__startswith='saves')
+        for i in range(posts)
+    ])
+    return list(Blog.objects.filter(subdomain__startswith='saves').order_by('pk'))
+
+
+def count_saves(posts, wrapper):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        with wrapper():
+            for post in posts:
+                post.save()
+        elapsed = (time.perf_counter() - start) * 1000
+    blog_updates = [query for query in queries if query['sql'].startswith('UPDATE "blogs_blog"')]
+    return {
+        'saves': len(posts),
+        'blogs': len({post.blog_id for post in posts}),
+        'ms': round(elapsed, 2),
+        'queries': len(queries),
+        'blog_updates': len(blog_updates),
+    }
+
+
+@benchmark('saves')
+def save_benchmark(repeat=5):
+    """
+    Counts the queries behind saving posts one at a time, in a transaction and in a batch,
+    checking each blog touched is only updated once however many of its posts were saved.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        blogs = seed()
+        posts = {blog.pk: list(Post.objects.filter(blog=blog).order_by('pk')) for blog in blogs}
+        one_blog = posts[blogs[0].pk]
+        every_blog = [post for blog_posts in zip(*posts.values()) for post in blog_posts]
+
+        results = {
+            'single': count_saves(one_blog[:1], nullcontext),
+            'transaction': count_saves(one_blog, transaction.atomic),
+            'batch': count_saves(one_blog, batched_blog_updates),
+            'batch_across_blogs': count_saves(every_blog, batched_blog_updates),
+        }
+
+        failures = [
+            f'{name}: blogs updated {result["blog_updates"]} times for {result["blogs"]} blogs'
+            for name, result in results.items()
+            if result['blog_updates'] != result['blogs']
+        ]
+        return {'results': results, 'failures': failures}
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,126 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from blogs import scores
+from blogs.benchmarks import benchmark, measure, speedup
+from blogs.models import Blog, Post, UserSettings
+
+from datetime import timedelta
+from unittest import mock
+import random
+import time
+
+
+# Posts scored in memory, and in the database from loading them to writing back
+POSTS = 1000000
+DB_POSTS = 100000
+
+
+def columns(posts, rng):
+    upvotes = [rng.choice((0, 1, 2, 5, 30, 400)) for _ in range(posts)]
+    shadow_votes = [rng.choice((0, 0, 0, 3, -1)) for _ in range(posts)]
+    seconds = [rng.uniform(1577811600, 1800000000) for _ in range(posts)]
+    return upvotes, shadow_votes, seconds, [0.0] * posts
+
+
+def seed(posts, rng):
+    user = User.objects.create_user(username='scores', email='scores@example.com')
+    UserSettings.objects.get_or_create(user=user)
+    Blog.objects.bulk_create([Blog(user=user, title='Scores', subdomain='scores', custom_styles='body { font-family: sans-serif; }')])
+    blog = Blog.objects.get(subdomain='scores')
+
+    now = timezone.now()
+    Post.objects.bulk_create((
+        Post(
+            blog=blog,
+            uid=f'scores{i}',
+            title=f'Post {i}',
+            slug=f'post-{i}',
+            content='Hello',
+            published_date=now - timedelta(hours=i),
+            make_discoverable=True,
+            upvotes=rng.choice((0, 1, 2, 5, 30, 400)),
+        )
+        for i in range(posts)
+    ), batch_size=5000)
+
+
+def rescore_timed(posts):
+    start = time.perf_counter()
+    changed = scores.rescore(posts)
+    return changed, (time.perf_counter() - start) * 1000
+
+
+def changes(posts):
+    # How many of posts a rescore should write back, scores that can't rank or land within
+    # TOLERANCE of the stored one aren't
+    _, upvotes, shadow_votes, seconds, current = scores.load(posts)
+    new_scores = scores.discover_scores(upvotes, shadow_votes, seconds, current)
+    return sum(1 for new, score in zip(new_scores, current) if abs(new - score) > scores.TOLERANCE)
+
+
+def throughput(posts, ms):
+    return round(posts / (ms / 1000)) if ms else None
+
+
+@benchmark('scores')
+def score_benchmark(repeat=5):
+    """
+    Times recomputing discover scores for a million posts in one pass, with NumPy and a post at a
+    time without it, and rescoring posts in the database writing back only the changed ones.
+    """
+    rng = random.Random(1)
+    failures = []
+    upvotes, shadow_votes, seconds, current = columns(POSTS, rng)
+
+    results = {'numpy': scores.numpy is not None}
+    with mock.patch.object(scores, 'numpy', None):
+        python = measure(lambda: scores.discover_scores(upvotes, shadow_votes, seconds, current), repeat=1)
+        expected = scores.discover_scores(upvotes, shadow_votes, seconds, current)
+    results['python'] = python
+    results['python_posts_per_second'] = throughput(POSTS, python['median_ms'])
+
+    if scores.numpy:
+        # As load hands them over
+        arrays = [scores.numpy.array(column, dtype=scores.numpy.float64) for column in (upvotes, shadow_votes, seconds, current)]
+        vectorized = measure(lambda: scores.discover_scores(*arrays), repeat=repeat)
+        computed = scores.discover_scores(*arrays)
+        if max(abs(a - b) for a, b in zip(computed.tolist(), expected)) > scores.TOLERANCE:
+            failures.append('vectorized scores differ from the ones computed a post at a time')
+        results['vectorized'] = vectorized
+        results['vectorized_posts_per_second'] = throughput(POSTS, vectorized['median_ms'])
+        results['speedup'] = speedup(python, vectorized)
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        seed(DB_POSTS, rng)
+        posts = Post.objects.filter(publish=True, make_discoverable=True)
+        expected = changes(posts)
+
+        changed, first_ms = rescore_timed(posts)
+        if changed != expected:
+            failures.append(f'first rescore changed {changed} posts, {expected} scores differ from the stored ones')
+
+        # Shadow votes on a few posts, only they should be written back
+        boosted = list(posts.filter(upvotes__gt=1, upvotes__lt=30).values_list('pk', flat=True)[:DB_POSTS // 100])
+        Post.objects.filter(pk__in=boosted).update(shadow_votes=5)
+        changed, boosted_ms = rescore_timed(posts)
+        if changed != len(boosted):
+            failures.append(f'rescore after boosting {len(boosted)} posts changed {changed}')
+
+        changed, unchanged_ms = rescore_timed(posts)
+        if changed:
+            failures.append(f'rescore with nothing changed wrote {changed} posts')
+
+        results['database'] = {
+            'posts': DB_POSTS,
+            'first_rescore_ms': round(first_ms, 1),
+            'boosted': len(boosted),
+            'boosted_rescore_ms': round(boosted_ms, 1),
+            'unchanged_rescore_ms': round(unchanged_ms, 1),
+            'posts_per_second': throughput(DB_POSTS, unchanged_ms),
+        }
+        return {'results': results, 'failures': failures}
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,113 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from blogs.benchmarks import benchmark, measure, speedup
+from blogs.models import Blog, BlogTag, Post, UserSettings
+
+from datetime import timedelta
+import json
+import random
+
+
+BLOG_SIZES = (100, 3000)
+
+
+def seed(posts):
+    user = User.objects.create_user(username=f'tags{posts}', email=f'tags{posts}@example.com')
+    UserSettings.objects.get_or_create(user=user)
+    Blog.objects.bulk_create([Blog(user=user, title='Tags', subdomain=f'tags{posts}', custom_styles='body { font-family: sans-serif; }')])
+    blog = Blog.objects.get(subdomain=f'tags{posts}')
+
+    now = timezone.now()
+    Post.objects.bulk_create([
+        Post(
+            blog=blog,
+            uid=f'tags{posts}-{i}',
+            title=f'Post {i}',
+            slug=f'post-{i}',
+            content='Hello',
+            published_date=now - timedelta(days=i),
+            all_tags=json.dumps([f'tag{i % 40}', f'tag{i % 7}']),
+            all_tools=json.dumps([f'tool{i % 5}']),
+        )
+        for i in range(posts)
+    ])
+    BlogTag.rebuild(blog)
+    return blog
+
+
+def legacy_update_all_tags(blog):
+    # What Blog.save did before the counts, for comparison and to check them against
+    all_tags = set()
+    all_tools = set()
+    for post in Post.objects.filter(blog=blog, publish=True, is_page=False, published_date__lt=timezone.now()):
+        all_tags.update(json.loads(post.all_tags))
+        all_tools.update(json.loads(post.all_tools))
+    return all_tags, all_tools
+
+
+def shuffle_tags(post, rng):
+    post.all_tags = json.dumps(rng.sample([f'tag{n}' for n in range(50)], rng.randint(0, 3)))
+    post.all_tools = json.dumps(rng.sample([f'tool{n}' for n in range(8)], rng.randint(0, 2)))
+
+
+def edit(blog, rng):
+    # Tag changes, unpublishing, turning into a page, scheduling, new posts and deletes
+    post = Post.objects.filter(blog=blog).order_by('?').first()
+    change = rng.randrange(6)
+    if change == 0:
+        shuffle_tags(post, rng)
+    elif change == 1:
+        post.publish = not post.publish
+    elif change == 2:
+        post.is_page = not post.is_page
+    elif change == 3:
+        post.published_date = timezone.now() + timedelta(days=rng.choice((-1, 1)))
+    elif change == 4:
+        post = Post(blog=blog, title='New', slug=f'new-{rng.random()}', content='Hello', published_date=timezone.now() - timedelta(days=1))
+        shuffle_tags(post, rng)
+    else:
+        post.delete()
+        Blog.objects.get(pk=blog.pk).save()
+        return
+    post.save()
+
+
+@benchmark('tags')
+def tag_benchmark(repeat=5):
+    """
+    Times saving a post in blogs of different sizes, which used to rescan every post of the
+    blog for its tags, and checks the counts kept instead against a rescan after random edits.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        results = {}
+        failures = []
+        for size in BLOG_SIZES:
+            blog = seed(size)
+            rng = random.Random(size)
+            post = Post.objects.filter(blog=blog).first()
+
+            with CaptureQueriesContext(connection) as queries:
+                saves = measure(lambda: (shuffle_tags(post, rng), post.save()), repeat=repeat * 4)
+            legacy = measure(lambda: legacy_update_all_tags(blog), repeat=repeat)
+
+            for _ in range(repeat * 20):
+                edit(blog, rng)
+            blog = Blog.objects.get(pk=blog.pk)
+            if (set(blog.tags), set(blog.tools)) != legacy_update_all_tags(blog):
+                failures.append(f'tag counts drifted in a blog of {size} posts')
+
+            results[size] = {
+                'post_save': saves,
+                'queries_per_save': round(len(queries) / (repeat * 4), 1),
+                'legacy_update_all_tags': legacy,
+            }
+
+        small, large = (results[size]['post_save'] for size in BLOG_SIZES)
+        results['large_blog_slowdown'] = speedup(large, small)
+        return {'results': results, 'failures': failures}
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,99 @@
+from blogs.benchmarks import benchmark, measure, speedup
+from blogs.terms import TermMatcher, term_matcher
+
+import random
+import string
+
+
+TERMS = 500
+CONTENT_BYTES = 100 * 1024
+
+
+def words(rng, count):
+    return [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10))) for _ in range(count)]
+
+
+def review_terms(rng):
+    # Single words and phrases, some in capitals, as staff type them into the store
+    vocabulary = words(rng, TERMS * 2)
+    terms = rng.sample(vocabulary, TERMS)
+    phrases = [f'{a} {b}' for a, b in zip(terms[:50], terms[50:100])]
+    highlight = [term.upper() if i % 7 == 0 else term for i, term in enumerate(terms[:TERMS - 150] + phrases)]
+    blacklist = terms[TERMS - 100:]
+    return vocabulary, highlight, blacklist
+
+
+def content(rng, vocabulary):
+    text = []
+    size = 0
+    while size < CONTENT_BYTES:
+        word = rng.choice(vocabulary)
+        word = word.title() if rng.random() < 0.2 else word
+        text.append(word)
+        size += len(word) + 1
+    return ' '.join(text)[:CONTENT_BYTES]
+
+
+def legacy_dodginess(all_content, highlight_terms, blacklist_terms):
+    # What determine_dodginess did before, lowercasing and counting once per term
+    dodgy_term_count = 0
+    blacklisted_term_count = 0
+    for term in highlight_terms:
+        dodgy_term_count += all_content.lower().count(term.lower())
+    for term in blacklist_terms:
+        blacklisted_term_count += all_content.lower().count(term.lower())
+    return dodgy_term_count + blacklisted_term_count * 10
+
+
+def weighted(highlight_terms, blacklist_terms):
+    return [(term, 1) for term in highlight_terms] + [(term, 10) for term in blacklist_terms]
+
+
+# Terms overlapping themselves, each other and appearing twice, where counting them one at a time is easy to get wrong
+EDGE_CASES = [
+    (['aa'], ['aa'], 'aaaaa AAA'),
+    (['casino', 'online casino'], ['sino'], 'Online Casino, online casinos, CASINO'),
+    (['abc', 'bcd', 'cde'], [], 'abcde abcd bcde'),
+    (['ab', 'ab'], ['b'], 'abab'),
+    (['ünïcödé', 'straße'], ['é'], 'ÜNÏCÖDÉ Straße straße é'),
+    (['x', ''], [], 'xyx'),
+]
+
+
+@benchmark('terms')
+def term_benchmark(repeat=5):
+    """
+    Times scoring 100KB of blog content against 500 review terms, counting them one at a time
+    as before and in one pass with the compiled matcher, and checks both score the same.
+    """
+    rng = random.Random(1)
+    vocabulary, highlight, blacklist = review_terms(rng)
+    text = content(rng, vocabulary)
+    failures = []
+
+    legacy = measure(lambda: legacy_dodginess(text, highlight, blacklist), repeat=repeat)
+    compiled = measure(lambda: TermMatcher(weighted(highlight, blacklist)), repeat=repeat)
+    matcher = term_matcher(weighted(highlight, blacklist))
+    matched = measure(lambda: matcher.score(text), repeat=repeat)
+
+    if matcher.score(text) != legacy_dodginess(text, highlight, blacklist):
+        failures.append('matcher scores differ from counting terms one at a time')
+    if term_matcher(weighted(highlight, blacklist)) is not matcher:
+        failures.append('matcher was compiled again for the same terms')
+
+    for highlight_terms, blacklist_terms, edge_case in EDGE_CASES:
+        # An empty term used to count every position, it's skipped now
+        expected = legacy_dodginess(edge_case, [term for term in highlight_terms if term], blacklist_terms)
+        if TermMatcher(weighted(highlight_terms, blacklist_terms)).score(edge_case) != expected:
+            failures.append(f'matcher scores {edge_case!r} differently')
+
+    return {
+        'terms': len(highlight) + len(blacklist),
+        'content_bytes': len(text),
+        'matches': sum(matcher.counts(text).values()),
+        'legacy': legacy,
+        'compile': compiled,
+        'matcher': matched,
+        'speedup': speedup(legacy, matched),
+        'failures': failures,
+    }
@@ -0,0 +1,100 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from blogs.benchmarks import benchmark, speedup
+from blogs.models import Blog, Post, Upvote, UserSettings
+from blogs.scores import discover_score
+
+from io import StringIO
+from statistics import median
+import time
+
+
+BURST = 3000
+
+# Upvotes timed at the start and end of the burst, to check they don't slow down as votes pile up
+SAMPLE = 300
+
+
+def seed():
+    user = User.objects.create_user(username='upvotes', email='upvotes@example.com')
+    UserSettings.objects.get_or_create(user=user)
+    Blog.objects.bulk_create([Blog(user=user, title='Upvotes', subdomain='upvotes', custom_styles='body { font-family: sans-serif; }')])
+    blog = Blog.objects.get(subdomain='upvotes')
+    Post.objects.bulk_create([
+        Post(blog=blog, uid=f'upvotes{i}', title=f'Post {i}', slug=f'post-{i}', content='Hello', published_date=timezone.now(), make_discoverable=True)
+        for i in range(2)
+    ])
+    return list(Post.objects.filter(blog=blog).order_by('pk'))
+
+
+def upvote(post, hash_id):
+    Upvote(post=post, hash_id=hash_id).save()
+
+
+def legacy_upvote(post, hash_id):
+    # What an upvote did before, a full post save recounting its upvotes
+    Upvote(post=post, hash_id=hash_id).save()
+    post.save()
+
+
+def time_burst(upvote, post, count, prefix):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        upvote(post, f'{prefix}{i}')
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+@benchmark('upvotes')
+def upvote_benchmark(repeat=5):
+    """
+    Times a burst of upvotes on one post, checking each takes as long as the first however many
+    came before it, that duplicates are turned down and that update_scores catches the score up.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        post, legacy_post = seed()
+        failures = []
+
+        timings = time_burst(upvote, post, BURST - SAMPLE, 'burst')
+        with CaptureQueriesContext(connection) as queries:
+            timings += time_burst(upvote, post, SAMPLE, 'late')
+        first, last = median(timings[:SAMPLE]), median(timings[-SAMPLE:])
+        if last > first * 2:
+            failures.append(f'upvotes slowed from {first:.3f}ms to {last:.3f}ms over the burst')
+
+        try:
+            Upvote(post=post, hash_id='burst0').save()
+            failures.append('duplicate upvote was saved')
+        except IntegrityError:
+            pass
+
+        post.refresh_from_db()
+        if post.upvotes != BURST:
+            failures.append(f'{post.upvotes} upvotes counted for {BURST}')
+
+        call_command('update_scores', stdout=StringIO())
+        post.refresh_from_db()
+        if post.score != discover_score(post.upvotes, post.shadow_votes, post.first_published_at or post.published_date):
+            failures.append('update_scores left the score behind')
+
+        legacy = time_burst(legacy_upvote, legacy_post, SAMPLE * 2, 'legacy')
+        legacy_first, legacy_last = median(legacy[:SAMPLE]), median(legacy[-SAMPLE:])
+
+        return {
+            'burst': BURST,
+            'queries_per_upvote': round(len(queries) / SAMPLE, 1),
+            'first_median_ms': round(first, 3),
+            'last_median_ms': round(last, 3),
+            'legacy_first_median_ms': round(legacy_first, 3),
+            'legacy_last_median_ms': round(legacy_last, 3),
+            'speedup': speedup({'median_ms': legacy_last}, {'median_ms': last}),
+            'failures': failures,
+        }
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
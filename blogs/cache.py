@@ -0,0 +1,144 @@
+from django.conf import settings
+from django.core.cache import cache as django_cache
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+# Every LRUCache registers itself here so its stats can be shown on the staff performance dashboard
+registry = {}
+
+
+def shared_cache_enabled():
+    return 'locmem' not in settings.CACHES['default']['BACKEND']
+
+
+class LRUCache:
+    """
+    Bounded in-process cache that evicts the least recently used entry.
+    Keeps hit/miss/eviction counters so it can be sized from the staff dashboard.
+
+    With shared=True, local misses fall through to the shared (Redis) cache and
+    sets are written through to it, so every gunicorn worker benefits.
+
+    With a ttl (in seconds) entries expire, which bounds how stale a worker's
+    copy can get when another worker deletes it.
+    """
+
+    def __init__(self, name, max_entries=1000, max_bytes=None, shared=False, shared_timeout=60 * 60 * 24, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.shared_timeout = ttl or shared_timeout
+        self.ttl = ttl
+        self.shared_hits = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        registry[name] = self
+
+    def shared_key(self, key):
+        return f"{self.name}:{hashlib.sha256(str(key).encode('utf-8')).hexdigest()}"
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+                if key in self._expires and self._expires[key] < time.monotonic():
+                    self._remove(key)
+                    raise KeyError(key)
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+
+        if self.shared and shared_cache_enabled():
+            value = django_cache.get(self.shared_key(key))
+            if value is not None:
+                self.shared_hits += 1
+                self.set(key, value, shared=False)
+                return value
+
+        return default
+
+    def set(self, key, value, size=None, shared=True, ttl=None):
+        # ttl overrides the cache's own for this entry
+        ttl = ttl or self.ttl
+        if self.shared and shared and shared_cache_enabled():
+            django_cache.set(self.shared_key(key), value, ttl or self.shared_timeout)
+
+        if size is None:
+            size = len(value) if isinstance(value, (str, bytes)) else 1
+
+        # Don't let a single huge value flush the whole cache
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+            self._data[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            if ttl:
+                self._expires[key] = time.monotonic() + ttl
+
+            while len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+                old_key = next(iter(self._data))
+                self._remove(old_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._data[key]
+        self.bytes -= self._sizes.pop(key)
+        self._expires.pop(key, None)
+
+    def delete(self, key, shared=True):
+        if self.shared and shared and shared_cache_enabled():
+            django_cache.delete(self.shared_key(key))
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self.bytes = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared_hits': self.shared_hits,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits / lookups * 100) if lookups else 0,
+        }
+
+
+def cache_stats():
+    return [cache.stats() for cache in registry.values()]
@@ -0,0 +1,141 @@
+from django.db import transaction
+
+import atexit
+import os
+import threading
+import time
+import requests
+
+
+# Purges wait this many seconds for others to join them, so a burst of saves to a blog purges it once
+PURGE_WINDOW = 2
+
+# Cloudflare takes at most 30 tags per purge request
+MAX_TAGS_PER_PURGE = 30
+
+PURGE_TIMEOUT = 10
+
+# Tags are retried on the next flush when Cloudflare doesn't accept them, up to this many times in all
+MAX_ATTEMPTS = 3
+
+# Cache tags, so a write only purges the pages it shows up on. Every page of a blog is also tagged
+# with its subdomain, which purges all of them.
+DISCOVER_TAG = 'discover'
+
+
+def index_tag(blog_id):
+    # Pages listing the blog's posts: home, the posts page, the sitemap and posts embedding a list
+    return f'blog:{blog_id}:index'
+
+
+def feed_tag(blog_id):
+    return f'blog:{blog_id}:feed'
+
+
+def post_tag(blog_id, post_id):
+    return f'blog:{blog_id}:post:{post_id}'
+
+
+def tag_response(response, *tags):
+    response['Cache-Tag'] = ','.join(tags)
+    return response
+
+
+# Tag -> attempts so far, in the order they were queued
+pending = {}
+pending_lock = threading.Condition()
+worker = None
+
+
+def api_url():
+    # Overridable so a stub server can stand in for Cloudflare
+    return os.getenv('CLOUDFLARE_API_URL', 'https://api.cloudflare.com/client/v4')
+
+
+def credentials():
+    names = ('CLOUDFLARE_API_KEY', 'CLOUDFLARE_EMAIL', 'CLOUDFLARE_ZONE_ID')
+    values = [os.getenv(name) for name in names]
+    return values if all(values) else None
+
+
+def purge_tags(tags):
+    """Purges everything Cloudflare cached under tags in one request"""
+    cloudflare_api_key, cloudflare_email, cloudflare_zone_id = credentials()
+    headers = {
+        'X-Auth-Email': cloudflare_email,
+        'Authorization': f'Bearer {cloudflare_api_key}',
+        'Content-Type': 'application/json',
+    }
+    url = f"{api_url()}/zones/{cloudflare_zone_id}/purge_cache"
+
+    response = requests.post(url, headers=headers, json={'tags': tags}, timeout=PURGE_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def queue_purge(*tags):
+    """
+    Purges Cloudflare's cache for tags from a background thread, once the transaction commits.
+    Tags queued again before they're sent are only purged once.
+    """
+    tags = list(dict.fromkeys(tag for tag in tags if tag))
+    if not tags:
+        return
+
+    if os.getenv('ENVIRONMENT') == 'dev':
+        print("Invalidating cache for", ', '.join(tags))
+        return
+
+    if not credentials():
+        return
+
+    transaction.on_commit(lambda: enqueue(tags))
+
+
+def enqueue(tags):
+    global worker
+    with pending_lock:
+        for tag in tags:
+            pending.setdefault(tag, 0)
+
+        # Started here rather than at import so forked workers get their own
+        if worker is None or not worker.is_alive():
+            worker = threading.Thread(target=run_worker, name='cloudflare-purge', daemon=True)
+            worker.start()
+        pending_lock.notify()
+
+
+def send(batch):
+    try:
+        purge_tags(list(batch))
+        print(f"Invalidated Cloudflare cache for tags: {', '.join(batch)}")
+    except Exception as e:
+        print(f"Error invalidating Cloudflare cache for {', '.join(batch)}: {str(e)}")
+        with pending_lock:
+            for tag, attempts in batch.items():
+                if attempts + 1 < MAX_ATTEMPTS:
+                    pending.setdefault(tag, attempts + 1)
+
+
+def flush():
+    """Sends everything queued so far, in as few requests as Cloudflare allows"""
+    with pending_lock:
+        queued = dict(pending)
+        pending.clear()
+
+    tags = list(queued)
+    for start in range(0, len(tags), MAX_TAGS_PER_PURGE):
+        send({tag: queued[tag] for tag in tags[start:start + MAX_TAGS_PER_PURGE]})
+
+
+def run_worker():
+    while True:
+        with pending_lock:
+            while not pending:
+                pending_lock.wait()
+        time.sleep(PURGE_WINDOW)
+        flush()
+
+
+# Don't lose purges still waiting out the window when the process exits
+atexit.register(flush)
@@ -1,3 +1,4 @@
+import functools
 import os
 from .models import Blog
 from django.utils import timezone
@@ -10,67 +11,78 @@ def extra(request):
         'bear_root': 'http://' + os.getenv('MAIN_SITE_HOSTS').split(',')[0]
     }
 
+# The user's own blog, looked up at most once per request
+def request_user_blog(request):
+    if not hasattr(request, 'user_blog'):
+        request.user_blog = None
+        if request.user.is_authenticated:
+            try:
+                request.user_blog = Blog.objects.filter(user=request.user).first()
+            except:
+                pass
+    return request.user_blog
+
+
 # Add blog/space template variables for the current blog context
 def blog_space_variables(request):
     """
     Add template variables for both legacy (blog_*) and new (space_*) naming.
     This allows templates to use {{ blog_title }} or {{ space_title }} etc.
+
+    The values are callables, which templates call when they read them,
+    so pages that don't use them don't pay for the lookups.
     """
-    # Try to get blog from various sources
-    blog = None
-    
-    # First, try to get from URL resolution (for blog pages)
-    from .views.blog import resolve_address
-    try:
-        blog = resolve_address(request)
-    except:
-        pass
-    
-    # If no blog from URL, try user's blog (for dashboard pages)
-    if not blog and request.user.is_authenticated:
+    @functools.cache
+    def get_blog():
+        # First, try to get from URL resolution (for blog pages)
+        from .views.blog import resolve_address
         try:
-            blog = Blog.objects.filter(user=request.user).first()
+            blog = resolve_address(request)
         except:
-            pass
-    
-    if blog:
-        # Calculate relative dates
-        now = timezone.now()
-        blog_last_modified_days = (now - blog.last_modified).days if blog.last_modified else None
-        
+            blog = None
+
+        # If no blog from URL, try user's blog (for dashboard pages)
+        return blog or request_user_blog(request)
+
+    @functools.cache
+    def days_since_posted():
         # Get latest post date
-        latest_post = blog.posts.filter(publish=True, published_date__lte=now, is_page=False, is_template_draft=False).order_by('-published_date').first()
-        blog_last_posted_days = (now - latest_post.published_date).days if latest_post else None
-        
-        # Create template variables (both legacy and new naming)
-        template_vars = {
-            # Legacy blog_* variables (for Bear compatibility and docs)
-            'blog_title': blog.title,
-            'blog_description': blog.meta_description or blog.content[:157] + '...' if blog.content else '',
-            'blog_link': blog.useful_domain,
-            'blog_created_date': blog.created_date,
-            'blog_last_modified': f"{blog_last_modified_days} days" if blog_last_modified_days is not None else "unknown",
-            'blog_last_posted': f"{blog_last_posted_days} days" if blog_last_posted_days is not None else "unknown",
-            
-            # New space_* variables (for Vibera branding)
-            'space_title': blog.title,
-            'space_description': blog.meta_description or blog.content[:157] + '...' if blog.content else '',
-            'space_link': blog.useful_domain,
-            'space_created_date': blog.created_date,
-            'space_last_modified': f"{blog_last_modified_days} days" if blog_last_modified_days is not None else "unknown",
-            'space_last_posted': f"{blog_last_posted_days} days" if blog_last_posted_days is not None else "unknown",
-        }
-        
-        return template_vars
-    
-    return {}
+        now = timezone.now()
+        latest_post = get_blog().posts.filter(publish=True, published_date__lte=now, is_page=False, is_template_draft=False).order_by('-published_date').first()
+        return (now - latest_post.published_date).days if latest_post else None
+
+    def value(func):
+        def lazy():
+            return func(get_blog()) if get_blog() else ''
+        return lazy
+
+    def description(blog):
+        return blog.meta_description or blog.content[:157] + '...' if blog.content else ''
+
+    def last_modified(blog):
+        days = (timezone.now() - blog.last_modified).days if blog.last_modified else None
+        return f"{days} days" if days is not None else "unknown"
+
+    def last_posted(blog):
+        days = days_since_posted()
+        return f"{days} days" if days is not None else "unknown"
+
+    values = {
+        'title': value(lambda blog: blog.title),
+        'description': value(description),
+        'link': value(lambda blog: blog.useful_domain),
+        'created_date': value(lambda blog: blog.created_date),
+        'last_modified': value(last_modified),
+        'last_posted': value(last_posted),
+    }
+
+    # Legacy blog_* variables (for Bear compatibility and docs) and new space_* variables (for Vibera branding)
+    return {f'{prefix}_{name}': func for prefix in ('blog', 'space') for name, func in values.items()}
+
 
 # Add blog context for authenticated users (single-blog architecture)
 def user_blog(request):
     if request.user.is_authenticated:
-        try:
-            blog = Blog.objects.filter(user=request.user).first()
-            return {'blog': blog}
-        except:
-            pass
+        # Called by templates when they read it, unless the view passes its own blog
+        return {'blog': lambda: request_user_blog(request)}
     return {}
@@ -139,21 +139,37 @@ def get_country(user_ip):
         return {}
 
 
+# Same as !\[.*?\]\(.*?\) and \[.*?\]\(.*?\), but when there's no link from one bracket the rest of the
+# line can't have one either, so it's skipped instead of being rescanned from every following bracket
+MARKDOWN_IMAGE = re.compile(r'!\[(?:(?!\]\()[^\n])*+\]\([^\n)]*+\)|(!\[[^\n]*+)')
+MARKDOWN_LINK = re.compile(r'\[(?:(?!\]\()[^\n])*+\]\([^\n)]*+\)|(\[[^\n]*+)')
+
+# Same as ^\s*\|.*?\|\s*$ and ^\s*[:-]{3,}\s*$, but a run of blank lines that isn't followed by a
+# table is skipped in one go, instead of being rescanned from the start of every line in it
+TABLE_ROW = re.compile(r'^\s*\|.*?\|\s*$|^(\s++)', re.MULTILINE)
+TABLE_DIVIDER = re.compile(r'^\s*[:-]{3,}\s*$|^(\s++)', re.MULTILINE)
+
+
+# Removes the match, unless it's the part that's skipped
+def remove_match(match):
+    return match.group(1) or ''
+
+
 def unmark(content):
     content = re.sub(r'^\s{0,3}#{1,6}\s+.*$', '', content, flags=re.MULTILINE)
     content = re.sub(r'^\s{0,3}[-*]{3,}\s*$', '', content, flags=re.MULTILINE)
     content = re.sub(r'^\s{0,3}>\s+.*$', '', content, flags=re.MULTILINE)
     content = re.sub(r'```.*?```', '', content, flags=re.DOTALL)
     content = re.sub(r'`[^`]+`', '', content)
-    content = re.sub(r'!\[.*?\]\(.*?\)', '', content)
-    content = re.sub(r'\[.*?\]\(.*?\)', '', content)
+    content = MARKDOWN_IMAGE.sub(remove_match, content)
+    content = MARKDOWN_LINK.sub(remove_match, content)
     content = re.sub(r'(\*\*|__)(.*?)\1', '', content)
     content = re.sub(r'(\*|_)(.*?)\1', '', content)
     content = re.sub(r'~~.*?~~', '', content)
     content = re.sub(r'^\s{0,3}[-*+]\s+.*$', '', content, flags=re.MULTILINE)
     content = re.sub(r'^\s{0,3}\d+\.\s+.*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'^\s*\|.*?\|\s*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'^\s*[:-]{3,}\s*$', '', content, flags=re.MULTILINE)
+    content = TABLE_ROW.sub(remove_match, content)
+    content = TABLE_DIVIDER.sub(remove_match, content)
 
     return content
 
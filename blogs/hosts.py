@@ -0,0 +1,111 @@
+from django.core.cache import cache as django_cache
+from django.db import transaction
+
+from blogs.cache import LRUCache, shared_cache_enabled
+
+import copy
+import os
+import threading
+import time
+
+
+# Host -> Blog (with its user and settings), or False for hosts without an active blog.
+# Keys are prefixed with how the host was looked up, 'subdomain:' or 'domain:'.
+blog_hosts = LRUCache('blog_hosts', max_entries=20000, shared=True, ttl=60)
+
+# Normalized custom domains of active blogs, so pings for unknown domains don't touch the database.
+# Reloaded when the version in the shared cache changes, or after DOMAIN_INDEX_TTL without Redis.
+DOMAIN_INDEX_TTL = 60 * 5
+DOMAIN_INDEX_VERSION_KEY = 'domain_index_version'
+domain_index = None
+domain_index_version = None
+domain_index_loaded = 0
+domain_index_lock = threading.Lock()
+
+
+def main_site_hosts():
+    # Unset in shells, fixtures and commands, which still save blogs and drop their cached lookups
+    hosts = os.getenv('MAIN_SITE_HOSTS')
+    return hosts.split(',') if hosts else []
+
+
+def cached_blog(key, lookup):
+    """
+    Returns a copy of the blog cached for key, or calls lookup() and caches what it
+    returns, including None. Copies, so views can't change the cached snapshot.
+    """
+    blog = blog_hosts.get(key)
+    if blog is None:
+        blog = lookup() or False
+        blog_hosts.set(key, blog)
+    return copy.deepcopy(blog) if blog else None
+
+
+def host_keys(subdomain, domain):
+    keys = set()
+    if subdomain:
+        keys.update(f'subdomain:{subdomain}.{site}' for site in main_site_hosts())
+    if domain:
+        bare = domain.lower().removeprefix('www.')
+        keys.update((f'domain:{domain}', f'domain:{bare}', f'domain:www.{bare}'))
+    return keys
+
+
+def invalidate_hosts(*pairs):
+    """
+    Drops the cached lookups for (subdomain, domain) pairs once the transaction commits.
+    Other workers' local copies expire within the ttl.
+    """
+    keys = set()
+    for subdomain, domain in pairs:
+        keys |= host_keys(subdomain, domain)
+
+    def delete():
+        for key in keys:
+            blog_hosts.delete(key)
+
+    if keys:
+        transaction.on_commit(delete)
+
+
+def normalize_domain(domain):
+    return domain.strip().lower().removeprefix('www.')
+
+
+def current_domain_index_version():
+    if shared_cache_enabled():
+        return django_cache.get(DOMAIN_INDEX_VERSION_KEY, 0)
+    return 0
+
+
+def get_domain_index():
+    global domain_index, domain_index_version, domain_index_loaded
+    from blogs.models import Blog
+
+    version = current_domain_index_version()
+    with domain_index_lock:
+        if domain_index is None or version != domain_index_version or time.monotonic() - domain_index_loaded > DOMAIN_INDEX_TTL:
+            domain_index = set(Blog.objects.filter(user__is_active=True, normalized_domain__isnull=False).values_list('normalized_domain', flat=True))
+            domain_index_version = version
+            domain_index_loaded = time.monotonic()
+        return domain_index
+
+
+def known_domain(domain):
+    # False means no active blog has this domain, True still needs the lookup to find which
+    return normalize_domain(domain) in get_domain_index()
+
+
+def invalidate_domain_index():
+    """Reloads the domain index in every worker once the transaction commits"""
+    def bump():
+        global domain_index
+        with domain_index_lock:
+            domain_index = None
+        if shared_cache_enabled():
+            try:
+                django_cache.incr(DOMAIN_INDEX_VERSION_KEY)
+            except ValueError:
+                django_cache.set(DOMAIN_INDEX_VERSION_KEY, 1, None)
+
+    transaction.on_commit(bump)
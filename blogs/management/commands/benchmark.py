@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from blogs.benchmarks import registry
+import blogs.benchmarks.adversarial
+import blogs.benchmarks.lookups
+import blogs.benchmarks.pages
+import blogs.benchmarks.purges
+import blogs.benchmarks.rendering
+import blogs.benchmarks.saves
+import blogs.benchmarks.scores
+import blogs.benchmarks.tags
+import blogs.benchmarks.terms
+import blogs.benchmarks.upvotes
+import json
+
+
+class Command(BaseCommand):
+    help = 'Runs performance benchmarks and prints the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all)')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(registry)
+        unknown = [name for name in names if name not in registry]
+        if unknown:
+            raise CommandError(f"Unknown benchmark(s): {', '.join(unknown)}. Available: {', '.join(registry)}")
+
+        results = {}
+        for name in names:
+            self.stderr.write(f'Running {name}...')
+            results[name] = registry[name](repeat=options['repeat'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        # Benchmarks with time budgets list what went over them, so a CI run can fail on it
+        failures = [failure for result in results.values() for failure in result.get('failures', [])]
+        if failures:
+            raise CommandError(f"Over budget: {', '.join(failures)}")
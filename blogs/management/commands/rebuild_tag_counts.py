@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from blogs.models import Blog, BlogTag
+
+
+class Command(BaseCommand):
+    help = "Recounts blogs' tags and tools from their posts, in case the counts kept on save have drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('subdomains', nargs='*', help='Blogs to recount (default: all)')
+
+    def handle(self, *args, **options):
+        blogs = Blog.objects.all()
+        if options['subdomains']:
+            blogs = blogs.filter(subdomain__in=options['subdomains'])
+
+        total = blogs.count()
+        for i, blog in enumerate(blogs.order_by('pk').only('pk', 'subdomain').iterator(), 1):
+            BlogTag.rebuild(blog)
+            blog.update_all_tags()
+            # Not a save, which would purge and re-render the blog
+            Blog.objects.filter(pk=blog.pk).update(all_tags=blog.all_tags, all_tools=blog.all_tools)
+            if i % 1000 == 0:
+                self.stdout.write(f'{i}/{total} blogs recounted')
+
+        self.stdout.write(self.style.SUCCESS(f'Tags recounted for {total} blogs'))
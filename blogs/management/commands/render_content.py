@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from blogs.models import Blog, Post
+from blogs.templatetags.custom_tags import RENDERER_VERSION
+import os
+
+
+def render_chunk(model_name, pks):
+    # Each worker process needs its own database connection
+    connections.close_all()
+
+    model = Blog if model_name == 'blog' else Post
+    if model is Post:
+        objects = list(Post.objects.filter(pk__in=pks).select_related('blog__user__settings'))
+    else:
+        objects = list(Blog.objects.filter(pk__in=pks).select_related('user__settings'))
+
+    for obj in objects:
+        obj.render_content()
+
+    # bulk_update skips the Post.save -> Blog.save cascade
+    model.objects.bulk_update(objects, ['content_html', 'render_stamp'])
+    return len(objects)
+
+
+class Command(BaseCommand):
+    help = 'Re-renders stored post and blog HTML after a RENDERER_VERSION bump'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Re-render everything, not just content from older renderer versions')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--chunk-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        current_prefix = f"{RENDERER_VERSION}:"
+
+        for model_name, model in (('blog', Blog), ('post', Post)):
+            queryset = model.objects.all()
+            if not options['all']:
+                queryset = queryset.exclude(render_stamp__startswith=current_prefix)
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+
+            if not pks:
+                self.stdout.write(f'No stale {model_name}s')
+                continue
+
+            chunks = [pks[i:i + chunk_size] for i in range(0, len(pks), chunk_size)]
+            self.stdout.write(f'Rendering {len(pks)} {model_name}s in {len(chunks)} chunks')
+
+            # Don't hand the parent's open connection to forked workers
+            connections.close_all()
+
+            rendered = 0
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(render_chunk, model_name, chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    rendered += future.result()
+                    self.stdout.write(f'{rendered}/{len(pks)} {model_name}s rendered')
+
+        self.stdout.write(self.style.SUCCESS('All content rendered'))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from datetime import timedelta
+from blogs.cloudflare import DISCOVER_TAG, flush, queue_purge
+from blogs.models import Post, Upvote
+from blogs.scores import rescore
+import time
+
+
+class Command(BaseCommand):
+    help = 'Recounts upvotes and recomputes discover scores of recently upvoted posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=10, help='Posts upvoted in the last this many minutes (default: 10, run it as often)')
+        parser.add_argument('--all', action='store_true', help='Rescore every discoverable post instead, after changing shadow votes or how scores are computed')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['all']:
+            posts = Post.objects.filter(publish=True, make_discoverable=True)
+        else:
+            since = timezone.now() - timedelta(minutes=options['minutes'])
+            posts = Post.objects.filter(pk__in=Upvote.objects.filter(created_date__gte=since).values('post_id'))
+
+            # Counted in the database, so upvotes incrementing the counts meanwhile aren't lost
+            counts = Upvote.objects.filter(post=OuterRef('pk')).values('post').annotate(upvotes=Count('id')).values('upvotes')
+            posts.update(upvotes=Coalesce(Subquery(counts), 0))
+
+        changed = rescore(posts)
+
+        if changed:
+            queue_purge(DISCOVER_TAG)
+            flush()
+        self.stdout.write(self.style.SUCCESS(f'Scores updated for {changed} posts in {time.perf_counter() - start:.1f}s'))
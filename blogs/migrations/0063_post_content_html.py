@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-16 23:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0062_post_is_template_draft'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blog',
+            name='content_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='blog',
+            name='render_stamp',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='content_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='render_stamp',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.6 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+def normalize_hosts(apps, schema_editor):
+    Blog = apps.get_model('blogs', 'Blog')
+
+    # Subdomains are lowercased on save, but older rows may not be
+    taken = set(Blog.objects.values_list('subdomain', flat=True))
+    for blog in Blog.objects.exclude(subdomain__regex=r'^[^A-Z]*$').only('pk', 'subdomain'):
+        lowered = blog.subdomain.lower()
+        if lowered not in taken:
+            Blog.objects.filter(pk=blog.pk).update(subdomain=lowered)
+            taken.add(lowered)
+
+    # The first blog with a domain keeps it when others only differ by case or www
+    seen = set()
+    blogs = Blog.objects.exclude(domain__isnull=True).exclude(domain='').order_by('-user__is_active', 'pk')
+    for blog in blogs.only('pk', 'domain'):
+        normalized = blog.domain.strip().lower().removeprefix('www.')
+        if normalized and normalized not in seen:
+            Blog.objects.filter(pk=blog.pk).update(normalized_domain=normalized)
+            seen.add(normalized)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0063_post_content_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blog',
+            name='normalized_domain',
+            field=models.CharField(blank=True, editable=False, max_length=128, null=True),
+        ),
+        migrations.RunPython(normalize_hosts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='blog',
+            name='normalized_domain',
+            field=models.CharField(blank=True, editable=False, max_length=128, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.6 on 2026-10-17 11:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from collections import Counter
+import json
+
+
+def count_tags(apps, schema_editor):
+    Post = apps.get_model('blogs', 'Post')
+    BlogTag = apps.get_model('blogs', 'BlogTag')
+
+    counts = Counter()
+    posts = Post.objects.filter(publish=True, is_page=False).values_list('blog_id', 'all_tags', 'all_tools')
+    for blog_id, all_tags, all_tools in posts.iterator(chunk_size=2000):
+        counts.update((blog_id, 'tag', name) for name in set(json.loads(all_tags or '[]')))
+        counts.update((blog_id, 'tool', name) for name in set(json.loads(all_tools or '[]')))
+
+    BlogTag.objects.bulk_create(
+        (BlogTag(blog_id=blog_id, kind=kind, name=name, count=count) for (blog_id, kind, name), count in counts.items()),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0064_blog_normalized_domain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlogTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('tag', 'Tag'), ('tool', 'Tool')], max_length=4)),
+                ('name', models.TextField()),
+                ('count', models.IntegerField(default=0)),
+                ('blog', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tag_counts', to='blogs.blog')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('blog', 'kind', 'name'), name='unique_blog_tag')],
+            },
+        ),
+        migrations.RunPython(count_tags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.6 on 2026-10-17 00:57
+
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery
+
+
+def remove_duplicate_upvotes(apps, schema_editor):
+    Post = apps.get_model('blogs', 'Post')
+    Upvote = apps.get_model('blogs', 'Upvote')
+
+    # Keep the first upvote of each visitor to a post
+    duplicates = Upvote.objects.values('post_id', 'hash_id').annotate(upvotes=Count('id'), first=Min('id')).filter(upvotes__gt=1)
+    post_ids = set()
+    for duplicate in duplicates.iterator():
+        Upvote.objects.filter(post_id=duplicate['post_id'], hash_id=duplicate['hash_id']).exclude(id=duplicate['first']).delete()
+        post_ids.add(duplicate['post_id'])
+
+    counts = Upvote.objects.filter(post=OuterRef('pk')).values('post').annotate(upvotes=Count('id')).values('upvotes')
+    Post.objects.filter(pk__in=post_ids).update(upvotes=Subquery(counts))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0065_blogtag'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_upvotes, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='upvote',
+            name='blogs_upvot_post_id_537a4b_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='upvote',
+            constraint=models.UniqueConstraint(fields=('post', 'hash_id'), name='unique_upvote'),
+        ),
+    ]
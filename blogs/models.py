@@ -1,19 +1,29 @@
 from django.utils import timezone
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 from allauth.account.models import EmailAddress
 
+from blogs.cloudflare import DISCOVER_TAG, feed_tag, index_tag, post_tag, queue_purge
+from blogs.hosts import invalidate_domain_index, invalidate_hosts, normalize_domain
+from blogs.page_cache import purge_blog_pages
+from blogs.scores import discover_score
+from blogs.terms import term_matcher
+
 from zoneinfo import ZoneInfo
 import os
 import json
-from math import log
 import random
 import string
 import hashlib
-import requests
+from collections import Counter
+from contextlib import contextmanager
+import threading
+import weakref
 
 
 class UserSettings(models.Model):
@@ -41,6 +51,20 @@ def create_user_settings(sender, instance, **kwargs):
     # Auto-review disabled - manual review required
 
 
+# Cached blog lookups include the user and their settings, and skip inactive users
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=UserSettings)
+def invalidate_user_blog_hosts(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    user_id = instance.pk if sender is User else instance.user_id
+    hosts = Blog.objects.filter(user_id=user_id).values_list('subdomain', 'domain')
+    invalidate_hosts(*hosts)
+    if sender is User and any(domain for _, domain in hosts):
+        # Whether the user is active decides if their domains are in the index
+        invalidate_domain_index()
+
+
 class Blog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, related_name='blogs')
     title = models.CharField(max_length=200)
@@ -49,6 +73,8 @@ class Blog(models.Model):
     last_posted = models.DateTimeField(blank=True, null=True, db_index=True)
     subdomain = models.SlugField(max_length=100, unique=True, db_index=True)
     domain = models.CharField(max_length=128, blank=True, null=True, db_index=True)
+    # Lowercase and without www., so lookups can be exact matches on a unique index
+    normalized_domain = models.CharField(max_length=128, blank=True, null=True, unique=True, editable=False)
     auth_token = models.CharField(max_length=128, blank=True)
 
     nav = models.TextField(default="[Home](/) [Feed](/feed/)", blank=True)
@@ -63,6 +89,10 @@ class Blog(models.Model):
     all_tags = models.TextField(default='[]')
     all_tools = models.TextField(default='[]')
 
+    # Pre-rendered content, see render_content
+    content_html = models.TextField(blank=True, editable=False)
+    render_stamp = models.CharField(max_length=64, blank=True, editable=False)
+
     custom_styles = models.TextField(blank=True)
     overwrite_styles = models.BooleanField(
         default=False,
@@ -155,8 +185,6 @@ class Blog(models.Model):
 
     def determine_dodginess(self):
         persistent_store = PersistentStore.load()
-        dodgy_term_count = 0
-        blacklisted_term_count = 0
         all_content = f"{self.title} {self.content}"
         
         if self.pk:
@@ -164,59 +192,69 @@ class Blog(models.Model):
             if post:
                 all_content += f"{post.title} {post.content}"
 
-        for term in persistent_store.highlight_terms:
-            dodgy_term_count += all_content.lower().count(term.lower())
-
-        for term in persistent_store.blacklist_terms:
-            blacklisted_term_count += all_content.lower().count(term.lower())
-
-        self.dodginess_score = dodgy_term_count + blacklisted_term_count * 10
+        # Every term counted in one pass over the content
+        self.dodginess_score = persistent_store.dodginess_matcher().score(all_content)
 
     def update_all_tags(self):
-        all_tags = []
-        all_tools = []
+        # From the counts posts keep up to date as they're saved, rather than from every post.
+        # Scheduled and undated posts are counted, but their tags only show once they're out.
+        tags, tools = Counter(), Counter()
         if self.pk:
-            for post in Post.objects.filter(blog=self, publish=True, is_page=False, published_date__lt=timezone.now()):
-                all_tags.extend(json.loads(post.all_tags))
-                all_tools.extend(json.loads(post.all_tools))
-                all_tags = list(set(all_tags))
-                all_tools = list(set(all_tools))
-        self.all_tags = json.dumps(all_tags)
-        self.all_tools = json.dumps(all_tools)
-
-    def invalidate_cloudflare_cache(self):
-        if os.getenv('ENVIRONMENT') == 'dev':
-            print("Invalidating cache for", self.subdomain)
-            return
-
-        cloudflare_api_key = os.getenv('CLOUDFLARE_API_KEY')
-        cloudflare_email = os.getenv('CLOUDFLARE_EMAIL')
-        cloudflare_zone_id = os.getenv('CLOUDFLARE_ZONE_ID')
-        
-        if not all([cloudflare_api_key, cloudflare_email, cloudflare_zone_id]):
-            return
-            
-        headers = {
-            'X-Auth-Email': cloudflare_email,
-            'Authorization': f'Bearer {cloudflare_api_key}',
-            'Content-Type': 'application/json',
-        }
-        
-        url = f"https://api.cloudflare.com/client/v4/zones/{cloudflare_zone_id}/purge_cache"
-        
-        data = {
-            "tags": [self.subdomain]
-        }
-        
-        try:
-            response = requests.post(url, headers=headers, json=data)
-            response.raise_for_status()
-            print(f"Invalidated Cloudflare cache for tag: {self.subdomain}, response: {response.json()}")
-            return response.json()
-        except Exception as e:
-            # Log the error but don't prevent the save operation
-            print(f"Error invalidating Cloudflare cache for {self.subdomain}: {str(e)}")
-            return None
+            for kind, name, count in self.tag_counts.values_list('kind', 'name', 'count'):
+                (tags if kind == BlogTag.TAG else tools)[name] = count
+            unpublished = Q(published_date__gte=timezone.now()) | Q(published_date__isnull=True)
+            for post_tags, post_tools in self.posts.filter(unpublished, publish=True, is_page=False).values_list('all_tags', 'all_tools'):
+                tags.subtract(set(json.loads(post_tags)))
+                tools.subtract(set(json.loads(post_tools)))
+        self.all_tags = json.dumps([name for name, count in tags.items() if count > 0])
+        self.all_tools = json.dumps([name for name, count in tools.items() if count > 0])
+
+    def render_content(self):
+        from blogs.templatetags.custom_tags import render_stored
+
+        self.content_html, self.render_stamp = render_stored(str(self.content), self)
+
+    def update_post_stats(self):
+        # Update last posted
+        self.last_posted = self.posts.filter(publish=True, published_date__lt=timezone.now()).order_by('-published_date').values_list('published_date', flat=True).first()
+
+        # Update posts in last 24 hours
+        self.posts_in_last_24_hours = self.posts.filter(published_date__gte=timezone.now() - timezone.timedelta(hours=24), published_date__lte=timezone.now(), publish=True, make_discoverable=True).count()
+
+    def update_from_posts(self, cache_tags):
+        """
+        What a post save used to run the whole blog save for: recomputes the fields derived from
+        the blog's posts, without touching the rest, and purges the pages the posts show up on.
+        """
+        self.update_all_tags()
+        if not self.reviewed:
+            self.determine_dodginess()
+        self.update_post_stats()
+
+        Blog.objects.filter(pk=self.pk).update(
+            all_tags=self.all_tags,
+            all_tools=self.all_tools,
+            dodginess_score=self.dodginess_score,
+            last_posted=self.last_posted,
+            posts_in_last_24_hours=self.posts_in_last_24_hours,
+        )
+        invalidate_hosts((self.subdomain, self.domain))
+        purge_blog_pages(self.pk)
+        self.invalidate_cloudflare_cache(*cache_tags)
+
+    def invalidate_cloudflare_cache(self, *tags):
+        # Without tags, every page of the blog
+        queue_purge(*(tags or [self.subdomain]))
+
+    def domain_taken(self):
+        # Another blog has the domain, maybe in a different case or with www.
+        normalized = normalize_domain(self.domain or '')
+        return bool(normalized) and Blog.objects.filter(normalized_domain=normalized).exclude(pk=self.pk).exists()
+
+    def clean(self):
+        super().clean()
+        if self.domain_taken():
+            raise ValidationError({'domain': f'{self.domain} is already registered with another blog'})
 
     def save(self, *args, **kwargs):
         # Handle all tags
@@ -235,25 +273,136 @@ class Blog(models.Model):
         
         # Double check subdomains are lowercase
         self.subdomain = self.subdomain.lower()
+        self.normalized_domain = normalize_domain(self.domain or '') or None
+        if self.domain and self.domain == getattr(self, '_loaded_hosts', (None, None))[1] and self.domain_taken():
+            # Another blog had this domain before they were normalized, and keeps it. clean() turns
+            # away new clashes, and the unique constraint any that get past it.
+            self.normalized_domain = None
 
-        if self.pk:
-            # Update last posted
-            self.last_posted = self.posts.filter(publish=True, published_date__lt=timezone.now()).order_by('-published_date').values_list('published_date', flat=True).first()
+        # Store the rendered home page content
+        self.render_content()
 
-            # Update posts in last 24 hours
-            self.posts_in_last_24_hours = self.posts.filter(published_date__gte=timezone.now() - timezone.timedelta(hours=24), published_date__lte=timezone.now(), publish=True, make_discoverable=True).count()
+        if self.pk:
+            self.update_post_stats()
 
         # Save the blog
         super(Blog, self).save(*args, **kwargs)
+
+        # Drop cached lookups for its old and new hosts
+        old_subdomain, old_domain = getattr(self, '_loaded_hosts', (None, None))
+        invalidate_hosts((old_subdomain, old_domain), (self.subdomain, self.domain))
+        if (old_domain or None) != (self.domain or None):
+            invalidate_domain_index()
+        self._loaded_hosts = (self.subdomain, self.domain)
         
         # Invalidate Cloudflare cache after saving
         if self.pk:
-            self.invalidate_cloudflare_cache()
+            purge_blog_pages(self.pk)
+            self.invalidate_cloudflare_cache(self.subdomain, old_subdomain)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        blog = super().from_db(db, field_names, values)
+        # Remember the hosts it was loaded with, so a save can drop their cached lookups
+        blog._loaded_hosts = (blog.__dict__.get('subdomain'), blog.__dict__.get('domain'))
+        return blog
 
     def __str__(self):
         return f'{self.title} ({self.useful_domain})'
 
 
+class BlogUpdates(dict):
+    """
+    Blogs whose posts were saved -> the Cloudflare tags to purge, registered as a commit hook at
+    the savepoint the saves were made in. The first hook of a transaction to run updates each
+    blog of every hook that survived once, the rest find nothing left.
+    """
+
+    def __init__(self, alias):
+        super().__init__()
+        self.alias = alias
+
+    def add(self, blog_id, cache_tags):
+        self.setdefault(blog_id, {}).update(dict.fromkeys(cache_tags))
+
+    def __call__(self):
+        updates = {}
+        registry = pending_blog_updates()
+        for key, pending in list(registry.items()):
+            if key[0] == self.alias:
+                for blog_id, cache_tags in pending.items():
+                    updates.setdefault(blog_id, {}).update(cache_tags)
+                pending.clear()
+                registry.pop(key, None)
+        for blog in Blog.objects.filter(pk__in=updates):
+            blog.update_from_posts(updates[blog.pk])
+
+
+# (database alias, savepoint ids) -> the BlogUpdates registered there, in this thread. Only held
+# weakly, so when a rollback drops a hook its updates go with it.
+blog_updates = threading.local()
+
+
+def pending_blog_updates():
+    if not hasattr(blog_updates, 'registry'):
+        blog_updates.registry = weakref.WeakValueDictionary()
+        blog_updates.batch = None
+    return blog_updates.registry
+
+
+def defer_blog_update(blog_id, cache_tags):
+    registry = pending_blog_updates()
+    if blog_updates.batch is not None:
+        blog_updates.batch.add(blog_id, cache_tags)
+        return
+
+    connection = transaction.get_connection()
+    key = (connection.alias, tuple(connection.savepoint_ids))
+    updates = registry.get(key)
+    if updates is not None:
+        updates.add(blog_id, cache_tags)
+        return
+
+    # Outside a transaction it runs right away
+    updates = registry[key] = BlogUpdates(connection.alias)
+    updates.add(blog_id, cache_tags)
+    transaction.on_commit(updates)
+
+
+@contextmanager
+def batched_blog_updates():
+    """Posts saved inside only update their blogs at the end, for loops that aren't in a transaction"""
+    pending_blog_updates()
+    if blog_updates.batch is not None:
+        yield
+        return
+
+    blog_updates.batch = batch = BlogUpdates(transaction.get_connection().alias)
+    try:
+        yield
+    finally:
+        blog_updates.batch = None
+        # Also after an error, for the posts saved before it
+        for blog_id, cache_tags in batch.items():
+            defer_blog_update(blog_id, cache_tags)
+
+
+def origin_model(origin):
+    # The model a delete started from, so receivers can tell a cascade from a delete of their own
+    return origin.model if isinstance(origin, models.QuerySet) else type(origin)
+
+
+@receiver(post_delete, sender=Blog)
+def invalidate_deleted_blog_hosts(sender, instance, **kwargs):
+    invalidate_hosts((instance.subdomain, instance.domain))
+    if instance.domain:
+        invalidate_domain_index()
+
+    # Every page at once, rather than post by post as its posts are deleted with it
+    purge_blog_pages(instance.pk)
+    queue_purge(instance.subdomain, DISCOVER_TAG)
+
+
 class Post(models.Model):
     blog = models.ForeignKey(Blog, on_delete=models.CASCADE, related_name='posts')
     uid = models.CharField(max_length=200, db_index=True)
@@ -273,6 +422,8 @@ class Post(models.Model):
     is_page = models.BooleanField(default=False, db_index=True)
     is_template_draft = models.BooleanField(default=False, db_index=True)
     content = models.TextField()
+    content_html = models.TextField(blank=True, editable=False)
+    render_stamp = models.CharField(max_length=64, blank=True, editable=False)
     canonical_url = models.CharField(max_length=200, blank=True)
     meta_description = models.CharField(max_length=200, blank=True)
     meta_image = models.CharField(max_length=200, blank=True)
@@ -323,25 +474,30 @@ class Post(models.Model):
 
     def update_score(self):
         self.upvotes = self.upvote_set.count()
-        upvotes = self.upvotes
-
-        if upvotes > 1: 
-            # Cap upvotes at 30 so they don't stick to the top forever
-            if upvotes > 30:
-                upvotes = 30
-
-            upvotes += self.shadow_votes
-
-            log_of_upvotes = log(upvotes, 10)
-
-            posted_at = self.first_published_at or self.published_date
-
-            seconds = posted_at.timestamp()
-            if seconds > 0:
-                # Lower buoyancy means posts sink faster with time
-                buoyancy = 14
-                score = (log_of_upvotes) + ((seconds - 1577811600) / (buoyancy * 86400))
-                self.score = score
+        score = discover_score(self.upvotes, self.shadow_votes, self.first_published_at or self.published_date)
+        if score is not None:
+            self.score = score
+
+    def render_content(self):
+        from blogs.templatetags.custom_tags import render_stored
+
+        self.content_html, self.render_stamp = render_stored(str(self.content), self.blog, self)
+
+    def tag_contribution(self):
+        # The tags and tools the post adds to its blog's counts
+        if not self.publish or self.is_page:
+            return set(), set()
+        return set(json.loads(self.all_tags or '[]')), set(json.loads(self.all_tools or '[]'))
+
+    def discoverable(self):
+        return self.publish and self.make_discoverable
+
+    def cache_tags(self):
+        # The pages a change to the post can show up on, the discover feed if it was or is on it
+        tags = [post_tag(self.blog_id, self.pk), index_tag(self.blog_id), feed_tag(self.blog_id)]
+        if self.discoverable() or getattr(self, '_loaded_discoverable', False):
+            tags.append(DISCOVER_TAG)
+        return tags
     
     def save(self, *args, **kwargs):
         self.slug = self.slug.lower()
@@ -364,31 +520,119 @@ class Post(models.Model):
         if self.pk:
             self.update_score()
 
+        # Store the rendered content so it isn't rendered on every read
+        self.render_content()
+
+        # What the post added to its blog's tag counts before this save
+        old_tags = getattr(self, '_loaded_tags', None)
+        if old_tags is None:
+            loaded = None if self._state.adding else Post.objects.filter(pk=self.pk).first()
+            old_tags = loaded.tag_contribution() if loaded else (set(), set())
+            self._loaded_discoverable = bool(loaded and loaded.discoverable())
+
         # Save the post
         super(Post, self).save(*args, **kwargs)
 
-        # Save blog to trigger a few other things
-        self.blog.save()
+        self._loaded_tags = self.tag_contribution()
+        BlogTag.adjust(self.blog_id, old_tags, self._loaded_tags)
+
+        # Update what the blog derives from its posts, once for all the posts saved in the transaction
+        defer_blog_update(self.blog_id, self.cache_tags())
+        self._loaded_discoverable = self.discoverable()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        post = super().from_db(db, field_names, values)
+        # Remember what it added to the blog's tag counts, so a save only applies the difference,
+        # and whether it was on the discover feed, so a save that takes it off still purges it
+        if {'publish', 'is_page', 'all_tags', 'all_tools', 'make_discoverable'} <= post.__dict__.keys():
+            post._loaded_tags = post.tag_contribution()
+            post._loaded_discoverable = post.discoverable()
+        return post
 
     def __str__(self):
         return self.title
 
 
+class BlogTag(models.Model):
+    """How many of a blog's published posts have each tag or tool"""
+    TAG = 'tag'
+    TOOL = 'tool'
+
+    blog = models.ForeignKey(Blog, on_delete=models.CASCADE, related_name='tag_counts')
+    kind = models.CharField(max_length=4, choices=[(TAG, 'Tag'), (TOOL, 'Tool')])
+    name = models.TextField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['blog', 'kind', 'name'], name='unique_blog_tag'),
+        ]
+
+    @classmethod
+    def adjust(cls, blog_id, old, new):
+        """Applies the change in what a post adds to the counts, given as (tags, tools) before and after"""
+        removed_any = False
+        for kind, before, after in ((cls.TAG, old[0], new[0]), (cls.TOOL, old[1], new[1])):
+            removed = before - after
+            if removed:
+                cls.objects.filter(blog_id=blog_id, kind=kind, name__in=removed).update(count=F('count') - 1)
+                removed_any = True
+
+            for name in after - before:
+                counts = cls.objects.filter(blog_id=blog_id, kind=kind, name=name)
+                if not counts.update(count=F('count') + 1):
+                    try:
+                        with transaction.atomic():
+                            cls.objects.create(blog_id=blog_id, kind=kind, name=name, count=1)
+                    except IntegrityError:
+                        # Another save created it first
+                        counts.update(count=F('count') + 1)
+
+        if removed_any:
+            cls.objects.filter(blog_id=blog_id, count__lte=0).delete()
+
+    @classmethod
+    def rebuild(cls, blog):
+        """Recounts a blog's tags and tools from all of its posts"""
+        tags, tools = Counter(), Counter()
+        for post in blog.posts.filter(publish=True, is_page=False).only('publish', 'is_page', 'all_tags', 'all_tools'):
+            post_tags, post_tools = post.tag_contribution()
+            tags.update(post_tags)
+            tools.update(post_tools)
+
+        with transaction.atomic():
+            cls.objects.filter(blog=blog).delete()
+            cls.objects.bulk_create(
+                [cls(blog=blog, kind=cls.TAG, name=name, count=count) for name, count in tags.items()] +
+                [cls(blog=blog, kind=cls.TOOL, name=name, count=count) for name, count in tools.items()]
+            )
+
+    def __str__(self):
+        return f'{self.name} ({self.kind}) x{self.count}'
+
+
 class Upvote(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
     created_date = models.DateTimeField(auto_now_add=True)
     hash_id = models.CharField(max_length=200)
 
     def save(self, *args, **kwargs):
-        # Save the Upvote instance
-        super(Upvote, self).save(*args, **kwargs)
-        
-        # Update the post score on post save
-        self.post.save()
+        adding = self._state.adding
+
+        # A second upvote from the same visitor fails the constraint, in a savepoint so the
+        # transaction around it carries on
+        with transaction.atomic():
+            super(Upvote, self).save(*args, **kwargs)
+
+            # Only the count, the score is recomputed in batches by update_scores. Post pages
+            # fetch the count with the visitor's state, so they needn't be purged either.
+            if adding:
+                Post.objects.filter(pk=self.post_id).update(upvotes=F('upvotes') + 1)
 
     class Meta:
-        indexes = [
-            models.Index(fields=['post', 'hash_id']),
+        constraints = [
+            models.UniqueConstraint(fields=['post', 'hash_id'], name='unique_upvote'),
         ]
 
     def __str__(self):
@@ -506,6 +750,10 @@ class PersistentStore(models.Model):
     def blacklist_terms(self):
         return sorted(json.loads(self.review_blacklist_terms))
     
+    def dodginess_matcher(self):
+        # Blacklisted terms count ten times as much as highlighted ones
+        return term_matcher([(term, 1) for term in self.highlight_terms] + [(term, 10) for term in self.blacklist_terms])
+
     @classmethod
     def load(cls):
         obj, created = cls.objects.get_or_create(pk=1)
@@ -548,3 +796,37 @@ class DangerousReport(models.Model):
     
     def __str__(self):
         return f"Report on '{self.post.title}' by {self.user.email}"
+
+
+# Deleted posts, comments and reports show on a blog's pages too
+@receiver(post_delete, sender=Post)
+def uncount_deleted_post_tags(sender, instance, origin=None, **kwargs):
+    # Not when the post goes with its blog or user, the counts go too
+    if origin_model(origin) is not Post:
+        return
+    old_tags = getattr(instance, '_loaded_tags', None) or instance.tag_contribution()
+    BlogTag.adjust(instance.blog_id, old_tags, (set(), set()))
+
+
+@receiver(post_delete, sender=Post)
+def purge_deleted_post_pages(sender, instance, origin=None, **kwargs):
+    # Its blog's pages are purged all at once when the post goes with it
+    if origin_model(origin) is not Post:
+        return
+    purge_blog_pages(instance.blog_id)
+    queue_purge(*instance.cache_tags())
+
+
+@receiver(post_delete, sender=Upvote)
+def uncount_deleted_upvote(sender, instance, origin=None, **kwargs):
+    # Not when the upvote goes with its post
+    if origin_model(origin) is not Upvote:
+        return
+    Post.objects.filter(pk=instance.post_id).update(upvotes=F('upvotes') - 1)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_save, sender=DangerousReport)
+def purge_post_pages(sender, instance, **kwargs):
+    purge_blog_pages(instance.post.blog_id)
+    queue_purge(post_tag(instance.post.blog_id, instance.post_id))
@@ -0,0 +1,269 @@
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.http import Http404, HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from blogs.cache import LRUCache, shared_cache_enabled
+
+from functools import wraps
+import gzip
+import hashlib
+import os
+import time
+
+try:
+    import brotli
+except ImportError:
+    # Pages are still stored gzipped without it
+    brotli = None
+
+
+# Rendered public blog pages. Keys include the blog's page version, which purge_blog_pages bumps,
+# so a purge only has to change one number instead of finding every page of the blog.
+page_cache = LRUCache('pages', max_entries=10000, max_bytes=128 * 1024 * 1024, shared=True, ttl=settings.PAGE_CACHE_TIMEOUT)
+
+# Headers that belong to the visitor the page was rendered for
+PRIVATE_HEADERS = {'set-cookie'}
+
+# Cached pages are compressed once when they're stored, instead of by GZipMiddleware on every request.
+# Brotli past quality 5 takes tens of milliseconds on a feed for a few percent.
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 5
+
+# Smaller than this isn't worth compressing, same as GZipMiddleware
+MIN_COMPRESS_LENGTH = 200
+
+
+def version_key(blog_id):
+    return f'page_version:{blog_id}'
+
+
+def purged_key(blog_id):
+    return f'page_purged:{blog_id}'
+
+
+def page_version(blog_id):
+    return django_cache.get(version_key(blog_id), 0)
+
+
+def purge_blog_pages(blog_id):
+    """Drops every cached page of the blog once the transaction commits"""
+    def bump():
+        try:
+            django_cache.incr(version_key(blog_id))
+        except ValueError:
+            django_cache.set(version_key(blog_id), 1, None)
+        # When, for Last-Modified, as blog saves from settings and comments don't move any timestamp
+        django_cache.set(purged_key(blog_id), int(time.time()), None)
+
+    transaction.on_commit(bump)
+
+
+def personal(request):
+    # Previews of drafts
+    if 'token' in request.GET:
+        return True
+
+    admin_passport = os.getenv('ADMIN_PASSPORT')
+    if admin_passport and request.COOKIES.get('admin_passport') == admin_passport:
+        return True
+
+    # Owners see edit links, and signed in visitors their comments and reports
+    return request.user.is_authenticated
+
+
+def bypass(request):
+    return not settings.PAGE_CACHE or request.method not in ('GET', 'HEAD') or personal(request)
+
+
+def cacheable(response):
+    if response.status_code != 200 or response.streaming:
+        return False
+    if 'no-store' in response.get('Cache-Control', '') or 'private' in response.get('Cache-Control', ''):
+        return False
+    # A cookie, the CSRF one from a form's token included, means the page is personal
+    return not response.cookies
+
+
+def expires(next_post):
+    # Pages list posts by publish date, so they have to change when the next scheduled post goes live
+    if next_post:
+        return max(1, min(settings.PAGE_CACHE_TIMEOUT, int((next_post - timezone.now()).total_seconds())))
+    return settings.PAGE_CACHE_TIMEOUT
+
+
+def post_stamps(blog):
+    """
+    When the blog's posts were last edited and published, and when the next scheduled one goes live.
+    One aggregate that doesn't load any posts, cached until the page version changes or that post goes live.
+    """
+    key = f'{blog.pk}:{page_version(blog.pk)}:stamps'
+    stamps = page_cache.get(key)
+    if stamps is None:
+        now = timezone.now()
+        stamps = blog.posts.aggregate(
+            last_modified=Max('last_modified'),
+            last_published=Max('published_date', filter=Q(publish=True, published_date__lte=now)),
+            next_post=Min('published_date', filter=Q(publish=True, published_date__gt=now)),
+        )
+        page_cache.set(key, stamps, ttl=expires(stamps['next_post']))
+    return stamps
+
+
+def timeout(blog):
+    return expires(post_stamps(blog)['next_post'])
+
+
+def validators(request, blog):
+    """
+    The ETag and Last-Modified timestamp of the page requested. Saves of the blog, its posts, comments
+    and reports bump the page version and stamp when they did, edits and scheduled posts going live
+    move the post timestamps.
+    """
+    from blogs.templatetags.custom_tags import RENDERER_VERSION
+
+    stamps = post_stamps(blog)
+    last_modified = int(max(stamp.timestamp() for stamp in (blog.last_modified, stamps['last_modified'], stamps['last_published']) if stamp))
+    last_modified = max(last_modified, django_cache.get(purged_key(blog.pk), 0))
+    tz = request.COOKIES.get('timezone', 'UTC')
+    # Per page, an ETag of one page doesn't match another
+    tag = f"{blog.pk}:{page_version(blog.pk)}:{RENDERER_VERSION}:{last_modified}:{tz}:{request.get_host()}{request.get_full_path()}"
+    # Weak, as the same page is sent compressed in different ways
+    return 'W/' + quote_etag(hashlib.sha1(tag.encode()).hexdigest()[:20]), last_modified
+
+
+def validating(request):
+    # Only when the page version is shared by every worker, one that missed a purge would answer 304s for the old page
+    if not settings.PAGE_CACHE or not shared_cache_enabled():
+        return False
+    return request.method in ('GET', 'HEAD') and not personal(request)
+
+
+def conditional_page(view):
+    """
+    Answers If-None-Match and If-Modified-Since requests for a public blog page with a 304,
+    before it's rendered or read from the page cache.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if getattr(request, 'page_validators', None) or not validating(request):
+            return view(request, *args, **kwargs)
+
+        from blogs.views.blog import resolve_address
+        try:
+            blog = resolve_address(request)
+        except Http404:
+            blog = None
+        if not blog:
+            return view(request, *args, **kwargs)
+
+        etag, last_modified = request.page_validators = validators(request, blog)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        if 'Cache-Control' not in response:
+            # Without it browsers guess a freshness lifetime from Last-Modified and skip asking.
+            # Cloudflare keeps its copy until a Cache-Tag purge or a scheduled post goes live.
+            response['Cache-Control'] = f'public, max-age=0, s-maxage={timeout(blog)}'
+        return response
+
+    return wrapped
+
+
+def compress(content):
+    """The page in each encoding it can be served in, most preferred first"""
+    if len(content) < MIN_COMPRESS_LENGTH:
+        return {}
+    encodings = {}
+    if brotli:
+        encodings['br'] = brotli.compress(content, quality=BROTLI_QUALITY)
+    encodings['gzip'] = gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)
+    return encodings
+
+
+def accepted_encodings(request):
+    """Encoding -> quality, of those the client takes"""
+    accepted = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = coding.partition(';')
+        name, _, quality = params.partition('=')
+        try:
+            quality = float(quality) if name.strip() == 'q' else 1
+        except ValueError:
+            quality = 1
+        # 'gzip;q=0' means anything but gzip
+        if quality > 0:
+            accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+def encode(request, response, entry):
+    # Vary even when sending it as is, so caches don't hand that to visitors that could take it compressed
+    patch_vary_headers(response, ('Accept-Encoding',))
+    accepted = accepted_encodings(request)
+    # The one the client prefers most, ties going to the order they're stored in
+    encodings = [encoding for encoding in entry['encoded'] if encoding in accepted]
+    if encodings:
+        encoding = max(encodings, key=lambda encoding: accepted[encoding])
+        response.content = entry['encoded'][encoding]
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def cached_page(view):
+    """
+    Serves a public blog page from the page cache, keyed by host, path and query,
+    and the timezone cookie the dates are rendered in.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        # A cached view calling another (post rendering the posts page or a feed) is handled by the outer one
+        if getattr(request, 'page_cache_key', None) or bypass(request):
+            return view(request, *args, **kwargs)
+
+        from blogs.views.blog import resolve_address
+        try:
+            blog = resolve_address(request)
+        except Http404:
+            blog = None
+        if not blog:
+            return view(request, *args, **kwargs)
+
+        tz = request.COOKIES.get('timezone', 'UTC')
+        request.page_cache_key = f"{blog.pk}:{page_version(blog.pk)}:{tz}:{request.get_host()}{request.get_full_path()}"
+
+        entry = page_cache.get(request.page_cache_key)
+        if entry is not None:
+            response = HttpResponse(entry['content'], status=entry['status'])
+            for header, value in entry['headers']:
+                response[header] = value
+            response['X-Page-Cache'] = 'hit'
+            return encode(request, response, entry)
+
+        response = view(request, *args, **kwargs)
+        if cacheable(response):
+            # Views tag their pages more finely, anything else goes when the blog is purged
+            if 'Cache-Tag' not in response:
+                response['Cache-Tag'] = blog.subdomain
+            entry = {
+                'status': response.status_code,
+                'content': response.content,
+                'headers': [(header, value) for header, value in response.items() if header.lower() not in PRIVATE_HEADERS],
+                'encoded': compress(response.content),
+            }
+            size = len(entry['content']) + sum(len(content) for content in entry['encoded'].values())
+            page_cache.set(request.page_cache_key, entry, size=size, ttl=timeout(blog))
+            response['X-Page-Cache'] = 'miss'
+            return encode(request, response, entry)
+        return response
+
+    return wrapped
@@ -0,0 +1,120 @@
+from django.conf import settings
+
+from html import escape
+import atexit
+import hashlib
+import multiprocessing
+import re
+import threading
+
+from blogs.cache import LRUCache
+
+
+# Content hashes that rendered slowly in process ('slow') or ran out of time in the sandbox ('timeout')
+slow_renders = LRUCache('slow_renders', max_entries=10000, shared=True, ttl=settings.RENDER_SLOW_TTL)
+
+pool = None
+pool_lock = threading.Lock()
+
+# Mistune rescans the rest of a paragraph from every '[' and '|' it can't close, so a few
+# thousand of them in one paragraph take seconds, well before a post is big enough to be sandboxed
+PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n')
+MAX_BRACKETS = 1000
+MAX_PIPES = 5000
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def enabled():
+    return settings.RENDER_SANDBOX
+
+
+def looks_slow(content):
+    if content.count('[') <= MAX_BRACKETS and content.count('|') <= MAX_PIPES:
+        return False
+    return any(
+        paragraph.count('[') > MAX_BRACKETS or paragraph.count('|') > MAX_PIPES
+        for paragraph in PARAGRAPH_BREAK.split(content)
+    )
+
+
+def should_sandbox(content):
+    if not enabled():
+        return False
+    if len(content) > settings.RENDER_SANDBOX_MIN_SIZE or looks_slow(content):
+        return True
+    return slow_renders.get(content_hash(content)) is not None
+
+
+def timed_out(content):
+    return enabled() and slow_renders.get(content_hash(content)) == 'timeout'
+
+
+def record_duration(content, seconds):
+    # Send content that was slow in process to the sandbox next time it's rendered
+    if enabled() and seconds > settings.RENDER_SLOW_THRESHOLD:
+        print(f'Slow render: {len(content)} characters took {seconds:.1f}s')
+        slow_renders.set(content_hash(content), 'slow')
+
+
+def fallback(content):
+    return f'<div style="white-space: pre-wrap;">{escape(content)}</div>'
+
+
+def init_worker():
+    # A fresh process rather than a fork of the gunicorn worker, whose threads (the Cloudflare
+    # purge queue) could hold locks a fork would inherit locked, so it sets Django up itself
+    import django
+    django.setup()
+
+
+def render_worker(content, is_page, upgraded):
+    from blogs.models import Post
+    from blogs.templatetags.custom_tags import render_uncached
+
+    # The renderer only needs to know whether it's a page, so there's no need to touch the database
+    post = Post(is_page=is_page) if is_page is not None else None
+    return render_uncached(content, post, upgraded)
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = multiprocessing.get_context('forkserver').Pool(1, initializer=init_worker)
+        return pool
+
+
+def reset_pool():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            pool = None
+
+
+atexit.register(reset_pool)
+
+
+def render(content, post=None, upgraded=False):
+    """
+    Renders content in a separate process with a hard time limit.
+    Returns None if it has timed out, now or before.
+    """
+    key = content_hash(content)
+    if slow_renders.get(key) == 'timeout':
+        return None
+
+    is_page = post.is_page if post else None
+    result = get_pool().apply_async(render_worker, (content, is_page, upgraded))
+    try:
+        return result.get(timeout=settings.RENDER_TIME_BUDGET)
+    except multiprocessing.TimeoutError:
+        print(f'Render timed out after {settings.RENDER_TIME_BUDGET}s: {len(content)} characters, {key}')
+        # The worker is stuck on it, so replace it
+        reset_pool()
+        slow_renders.set(key, 'timeout')
+        return None
@@ -0,0 +1,267 @@
+from html import unescape
+from urllib.parse import urlsplit
+import re
+
+
+HOST_WHITELIST = {
+    'www.youtube.com',
+    'www.youtube-nocookie.com',
+    'www.slideshare.net',
+    'player.vimeo.com',
+    'w.soundcloud.com',
+    'www.google.com',
+    'codepen.io',
+    'stackblitz.com',
+    'onedrive.live.com',
+    'docs.google.com',
+    'bandcamp.com',
+    'embed.music.apple.com',
+    'drive.google.com',
+    'share.transistor.fm',
+    'share.descript.com',
+    'mrkennedy.ca',
+    'open.spotify.com',
+    'umap.openstreetmap.fr',
+    'music.163.com',
+    'sheevcharan.substack.com',
+    'guestbooks.meadow.cafe',
+    'supercut.video',
+    'listenbrainz.org',
+    'api.listenbrainz.org',
+    'archive.org'
+}
+
+# Tags that are removed while their contents are kept
+BLOCKED_TAGS = {'object', 'embed', 'form', 'input', 'button'}
+
+# Elements whose contents browsers read as text up to the closing tag
+RAW_TEXT_TAGS = {'style', 'textarea', 'title', 'xmp', 'noembed', 'noframes', 'noscript', 'plaintext'}
+
+# Anything a browser could start parsing at a '<'
+MARKUP_START = re.compile(r'<(?:[a-zA-Z]|!|\?|/)')
+BOGUS_COMMENT_START = re.compile(r'<(?:!|\?|/(?![a-zA-Z]))')
+
+# HTML only treats ASCII whitespace as whitespace (unlike \s)
+WHITESPACE = '\t\n\f\r '
+
+
+def attribute_grammar(name_guard='', value_guard=''):
+    # Attributes tokenized the way browsers do (quotes only count right at the start of a value,
+    # a name can start with '=' after a quoted value), with a lookahead guard before every
+    # attribute name and value character. Unguarded it only fails if the tag isn't closed.
+    name_start = f'[{WHITESPACE}/]*+{name_guard}[^{WHITESPACE}/>]'
+    value = '|'.join((
+        f'"(?:{value_guard}[^"])*+"',
+        f"'(?:{value_guard}[^'])*+'",
+        f'{value_guard}[^{WHITESPACE}>"\'](?:{value_guard}[^{WHITESPACE}>])*+(?=[{WHITESPACE}>]|\\Z)',
+        r'(?=>|\Z)',
+    ))
+    return f'(?:{name_start}[^{WHITESPACE}/>=]*+(?:[{WHITESPACE}]*+=[{WHITESPACE}]*+(?:{value})|(?![{WHITESPACE}]*+=)))*+'
+
+
+# Start or end tag
+TAG = re.compile(rf'<(/?)([a-zA-Z][^{WHITESPACE}/>]*+)({attribute_grammar()})[{WHITESPACE}/]*+>')
+ATTRIBUTE = re.compile(rf'''[{WHITESPACE}/]*+([^{WHITESPACE}/>][^{WHITESPACE}/>=]*+)(?:[{WHITESPACE}]*+=[{WHITESPACE}]*+("[^"]*+"|'[^']*+'|[^{WHITESPACE}>"'][^{WHITESPACE}>]*+|\Z))?+''')
+
+# Attributes sanitize_tag would keep as they are: no on* or srcdoc names, and no values
+# that could hide a javascript:/vbscript: URL (an entity, or a 't' followed by ':')
+SAFE_ATTRIBUTES = attribute_grammar(r'(?!(?i:on|srcdoc))', r'(?!&|[tT][\x00-\x20]*+:)')
+SAFE_ATTRIBUTES_PATTERN = re.compile(SAFE_ATTRIBUTES)
+
+# Elements sanitize_range has to look at
+SPECIAL_TAGS = sorted(BLOCKED_TAGS | RAW_TEXT_TAGS | {'script', 'iframe'})
+
+# Text and tags that sanitize_range would copy unchanged, so they can be skipped in bulk
+SAFE_RUN = re.compile(
+    rf'''(?:[^<]++|<(?![a-zA-Z!?/])|<(?!/?(?i:{'|'.join(SPECIAL_TAGS)})[{WHITESPACE}/>])/?[a-zA-Z][^{WHITESPACE}/>]*+{SAFE_ATTRIBUTES}[{WHITESPACE}/]*+>)*+'''
+)
+
+COMMENT_END = re.compile(r'--!?>')
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x20]+')
+
+
+def closing_tag(name):
+    return re.compile(rf'</{name}[{WHITESPACE}/>]', re.IGNORECASE)
+
+
+CLOSING_TAGS = {name: closing_tag(name) for name in RAW_TEXT_TAGS | {'script', 'iframe'}}
+
+
+def is_javascript_url(value):
+    # Browsers decode entities and ignore whitespace and control characters in URLs.
+    # Checked anywhere in the value to also catch <animate values="...">.
+    url = CONTROL_CHARACTERS.sub('', unescape(value)).lower()
+    return 'javascript:' in url or 'vbscript:' in url
+
+
+def iframe_whitelisted(src):
+    if not src:
+        return False
+    try:
+        host = urlsplit(unescape(src).strip()).hostname
+    except ValueError:
+        return False
+    if not host:
+        return False
+
+    # Allow the whitelisted hosts and their subdomains
+    parts = host.split('.')
+    return any('.'.join(parts[i:]) in HOST_WHITELIST for i in range(len(parts) - 1))
+
+
+def attribute_value(value):
+    if value and value[0] in '"\'':
+        return value[1:-1]
+    return value or ''
+
+
+def sanitize_tag(tag_match):
+    """Returns the tag with event handlers and javascript: URLs removed, plus its src"""
+    kept = []
+    changed = False
+    src = None
+    for match in ATTRIBUTE.finditer(tag_match.group(3)):
+        name = match.group(1).lower()
+        value = attribute_value(match.group(2))
+        if name.startswith('on') or name == 'srcdoc' or is_javascript_url(value):
+            changed = True
+            continue
+        if name == 'src':
+            src = value
+        kept.append(match.group(0))
+
+    tag = tag_match.group(0)
+    if changed:
+        markup = tag_match.string
+        tag = markup[tag_match.start():tag_match.start(3)] + ''.join(kept) + markup[tag_match.end(3):tag_match.end()]
+    return tag, src
+
+
+def drop(output):
+    # Removing markup mustn't join a '<' left in the text onto whatever follows
+    if output and output[-1].endswith('<'):
+        output[-1] = output[-1][:-1] + '&lt;'
+
+
+def sanitize(markup):
+    """
+    Single pass HTML sanitizer for non-upgraded blogs. Removes script elements,
+    on* event handlers, javascript: URLs, object/embed/form/input/button tags and
+    iframes that aren't from a whitelisted host.
+    """
+    output = []
+    sanitize_range(markup, 0, len(markup), output, raw=False)
+    return ''.join(output)
+
+
+def skip_element(markup, name, pos, endpos):
+    # Returns where the element's closing tag ends, or endpos if it isn't closed
+    close = CLOSING_TAGS[name].search(markup, pos, endpos)
+    if not close:
+        return endpos
+    end = markup.find('>', close.end() - 1, endpos)
+    return endpos if end == -1 else end + 1
+
+
+def sanitize_range(markup, pos, endpos, output, raw):
+    """
+    Sanitizes markup[pos:endpos] into output. When raw is True the range is the
+    contents of a raw text element, which browsers read as text in HTML but as
+    markup inside <svg>/<math>, so it has to be safe either way.
+    """
+    while pos < endpos:
+        safe_end = SAFE_RUN.match(markup, pos, endpos).end()
+        if safe_end > pos:
+            output.append(markup[pos:safe_end])
+            pos = safe_end
+            if pos == endpos:
+                break
+
+        start = MARKUP_START.search(markup, pos, endpos)
+        if not start:
+            output.append(markup[pos:endpos])
+            break
+
+        index = start.start()
+        if index > pos:
+            output.append(markup[pos:index])
+
+        if markup.startswith('<!--', index, endpos):
+            # Comments, including the abrupt <!--> and <!--->
+            if markup.startswith('<!-->', index, endpos) or markup.startswith('<!--->', index, endpos):
+                end = markup.find('>', index, endpos) + 1
+            else:
+                comment_end = COMMENT_END.search(markup, index + 4, endpos)
+                end = comment_end.end() if comment_end else endpos
+            output.append(markup[index:end])
+            pos = end
+            continue
+
+        tag_match = TAG.match(markup, index, endpos)
+
+        if not tag_match:
+            if BOGUS_COMMENT_START.match(markup, index, endpos):
+                # Bogus comments (<!DOCTYPE ...>, <?...>, </1>) run to the first >
+                end = markup.find('>', index, endpos)
+                end = endpos if end == -1 else end + 1
+                output.append(markup[index:end])
+                pos = end
+            else:
+                # A tag that isn't closed, which browsers drop along with everything after it.
+                # Keep the rest as text rather than trying again from every '<' in it.
+                output.append(markup[index:endpos].replace('<', '&lt;'))
+                pos = endpos
+            continue
+
+        is_end_tag, name, attributes = tag_match.groups()
+        name = name.lower()
+        tag = tag_match.group(0)
+        pos = tag_match.end()
+
+        if name in BLOCKED_TAGS:
+            drop(output)
+            continue
+
+        if is_end_tag:
+            if name in ('script', 'iframe'):
+                drop(output)
+            else:
+                output.append(tag)
+            continue
+
+        if name == 'script':
+            drop(output)
+            pos = skip_element(markup, 'script', pos, endpos)
+            continue
+
+        src = None
+        if name == 'iframe' or not SAFE_ATTRIBUTES_PATTERN.fullmatch(attributes):
+            tag, src = sanitize_tag(tag_match)
+
+        if name == 'iframe':
+            if not iframe_whitelisted(src):
+                drop(output)
+                pos = skip_element(markup, 'iframe', pos, endpos)
+                continue
+            output.append(tag)
+            if raw:
+                # Already inside a range that's being sanitized as markup
+                continue
+            close = CLOSING_TAGS['iframe'].search(markup, pos, endpos)
+            content_end = close.start() if close else endpos
+            sanitize_range(markup, pos, content_end, output, raw=True)
+            pos = content_end
+            if close:
+                end = markup.find('>', close.end() - 1, endpos)
+                end = endpos if end == -1 else end + 1
+                output.append(markup[content_end:end])
+                pos = end
+            continue
+
+        output.append(tag)
+
+        if name in RAW_TEXT_TAGS and not raw:
+            close = CLOSING_TAGS[name].search(markup, pos, endpos) if name != 'plaintext' else None
+            content_end = close.start() if close else endpos
+            sanitize_range(markup, pos, content_end, output, raw=True)
+            pos = content_end
@@ -0,0 +1,93 @@
+from math import log10
+
+try:
+    import numpy
+except ImportError:
+    # Scores are computed a post at a time without it
+    numpy = None
+
+
+# Cap upvotes at 30 so they don't stick to the top forever
+UPVOTE_CAP = 30
+
+# Lower buoyancy means posts sink faster with time
+BUOYANCY = 14
+
+SCORE_EPOCH = 1577811600
+
+# Scores closer than this to the stored one aren't written back
+TOLERANCE = 1e-9
+
+
+def score_at(upvotes, shadow_votes, seconds):
+    """Where a post published at seconds ranks on discover, None while it can't rank"""
+    votes = min(upvotes, UPVOTE_CAP) + shadow_votes
+    if upvotes <= 1 or seconds <= 0 or votes <= 0:
+        return None
+    return log10(votes) + (seconds - SCORE_EPOCH) / (BUOYANCY * 86400)
+
+
+def discover_score(upvotes, shadow_votes, posted_at):
+    return score_at(upvotes, shadow_votes, posted_at.timestamp())
+
+
+def discover_scores(upvotes, shadow_votes, seconds, scores):
+    """
+    score_at for many posts in one pass over arrays of each, keeping the current score of those
+    that can't rank.
+    """
+    if numpy is None:
+        new_scores = [score_at(*post) for post in zip(upvotes, shadow_votes, seconds)]
+        return [score if new is None else new for new, score in zip(new_scores, scores)]
+
+    upvotes = numpy.asarray(upvotes, dtype=numpy.float64)
+    seconds = numpy.asarray(seconds, dtype=numpy.float64)
+    votes = numpy.minimum(upvotes, UPVOTE_CAP) + numpy.asarray(shadow_votes, dtype=numpy.float64)
+
+    ranked = (upvotes > 1) & (seconds > 0) & (votes > 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        new_scores = numpy.log10(votes) + (seconds - SCORE_EPOCH) / (BUOYANCY * 86400)
+    return numpy.where(ranked, new_scores, numpy.asarray(scores, dtype=numpy.float64))
+
+
+def load(posts, chunk_size=10000):
+    """The ids, upvotes, shadow votes, publish times in seconds and scores of posts, as columns"""
+    ids, upvotes, shadow_votes, seconds, scores = [], [], [], [], []
+    rows = posts.values_list('pk', 'upvotes', 'shadow_votes', 'first_published_at', 'published_date', 'score')
+    for pk, post_upvotes, post_shadow_votes, first_published_at, published_date, score in rows.iterator(chunk_size=chunk_size):
+        posted_at = first_published_at or published_date
+        ids.append(pk)
+        upvotes.append(post_upvotes)
+        shadow_votes.append(post_shadow_votes)
+        seconds.append(posted_at.timestamp() if posted_at else 0)
+        scores.append(score)
+
+    if numpy is None:
+        return ids, upvotes, shadow_votes, seconds, scores
+    return (
+        numpy.array(ids, dtype=numpy.int64),
+        numpy.array(upvotes, dtype=numpy.float64),
+        numpy.array(shadow_votes, dtype=numpy.float64),
+        numpy.array(seconds, dtype=numpy.float64),
+        numpy.array(scores, dtype=numpy.float64),
+    )
+
+
+def rescore(posts, batch_size=500):
+    """
+    Recomputes the discover scores of posts, a queryset, all at once and writes back only the
+    ones that changed. Returns how many did.
+    """
+    ids, upvotes, shadow_votes, seconds, scores = load(posts)
+    new_scores = discover_scores(upvotes, shadow_votes, seconds, scores)
+
+    if numpy is None:
+        changed = [(pk, new) for pk, new, score in zip(ids, new_scores, scores) if abs(new - score) > TOLERANCE]
+    else:
+        mask = numpy.abs(new_scores - scores) > TOLERANCE
+        changed = zip(ids[mask].tolist(), new_scores[mask].tolist())
+
+    Post = posts.model
+    updates = [Post(pk=pk, score=score) for pk, score in changed]
+    Post.objects.bulk_update(updates, ['score'], batch_size=batch_size)
+    return len(updates)
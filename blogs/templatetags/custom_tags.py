@@ -19,41 +19,35 @@ from mistune.directives import Admonition, TableOfContents
 from zoneinfo import ZoneInfo
 
 import latex2mathml.converter
+from bisect import bisect_left
+import functools
+import hashlib
 import re
+import time
+import uuid
 
+from blogs import render_sandbox
+from blogs.cache import LRUCache
 from blogs.helpers import unmark
-from blogs.models import Post
+from blogs.hosts import invalidate_hosts
+from blogs.models import Blog, Post
+from blogs.sanitizer import sanitize
 
 
 register = template.Library()
 
-HOST_WHITELIST = [
-    'www.youtube.com',
-    'www.youtube-nocookie.com',
-    'www.slideshare.net',
-    'player.vimeo.com',
-    'w.soundcloud.com',
-    'www.google.com',
-    'codepen.io',
-    'stackblitz.com',
-    'onedrive.live.com',
-    'docs.google.com',
-    'bandcamp.com',
-    'embed.music.apple.com',
-    'drive.google.com',
-    'share.transistor.fm',
-    'share.descript.com',
-    'mrkennedy.ca',
-    'open.spotify.com',
-    'umap.openstreetmap.fr',
-    'music.163.com',
-    'sheevcharan.substack.com',
-    'guestbooks.meadow.cafe',
-    'supercut.video',
-    'listenbrainz.org',
-    'api.listenbrainz.org',
-    'archive.org'
-]
+# Bump whenever MyRenderer, clean or the markdown plugins change output
+RENDERER_VERSION = 4
+
+# Rendered markdown (before {{ directive }} replacement) keyed by content hash + render fingerprint
+render_cache = LRUCache('markdown', max_entries=2000, max_bytes=64 * 1024 * 1024)
+
+# Highlighted code blocks keyed by (lexer name, code hash)
+highlight_cache = LRUCache('pygments', max_entries=5000, max_bytes=32 * 1024 * 1024)
+code_formatter = HtmlFormatter(style='friendly')
+
+# LaTeX to MathML is pure and slow, so formulas are shared by all workers when Redis is available
+mathml_cache = LRUCache('mathml', max_entries=10000, max_bytes=16 * 1024 * 1024, shared=True)
 
 TYPOGRAPHIC_REPLACEMENTS = [
     ('(c)', '©'),
@@ -79,20 +73,79 @@ def replace_inline_latex(text):
 
     return replaced_text
 
-def fix_links(text):
-    parentheses_pattern = r'\[([^\]]+)\]\(((?:tab:)?https?://[^\)]+\([^\)]+\)[^\)]*)\)'
+# A link label and the start of its URL. Otherwise skips to the next ']', since the brackets
+# before it share the label's end and can't start a link either.
+LINK_START = re.compile(r'\[([^\]]++)\]\(((?:tab:)?https?://)|\[[^\]]*+')
+
+
+def next_position(positions, start):
+    index = bisect_left(positions, start)
+    return positions[index] if index < len(positions) else -1
 
-    def escape_parentheses(match):
-        label = match.group(1)
-        url = match.group(2)
+
+def fix_links(text):
+    r"""
+    Escapes the parentheses in links like [label](https://en.wikipedia.org/wiki/Foo_(bar)).
+
+    Same output as re.sub(r'\[([^\]]+)\]\(((?:tab:)?https?://[^\)]+\([^\)]+\)[^\)]*)\)', ...),
+    which rescanned the rest of the post for every unclosed bracket, so parentheses
+    are looked up in sorted position lists instead.
+    """
+    if '](' not in text:
+        return text
+
+    opening = closing = None
+    output = []
+    pos = 0
+    for match in LINK_START.finditer(text):
+        if match.group(2) is None or match.start() < pos:
+            continue
+        if opening is None:
+            opening = [m.start() for m in re.finditer(r'\(', text)]
+            closing = [m.start() for m in re.finditer(r'\)', text)]
+
+        # The URL needs a '(' with something on both sides before its first ')', then a second ')' to close the link
+        url_start = match.end()
+        first_close = next_position(closing, url_start)
+        if first_close == -1:
+            # No link can be closed from here on
+            break
+        inner_open = next_position(opening, url_start + 1)
+        if inner_open == -1 or inner_open > first_close - 2:
+            continue
+        link_close = next_position(closing, first_close + 1)
+        if link_close == -1:
+            break
+
+        url = text[match.start(2):link_close]
         # Escape parentheses in the URL
         escaped_url = url.replace('(', '%28').replace(')', '%29')
-        return f'[{label}]({escaped_url})'
+        output.append(text[pos:match.start()])
+        output.append(f'[{match.group(1)}]({escaped_url})')
+        pos = link_close + 1
+
+    if not output:
+        return text
+    output.append(text[pos:])
+    return ''.join(output)
+
+
+def convert_latex(text):
+    mathml = mathml_cache.get(text)
+    if mathml is None:
+        mathml = latex2mathml.converter.convert(text)
+        mathml_cache.set(text, mathml)
+    return mathml
 
-    fixed_text = re.sub(parentheses_pattern, escape_parentheses, text)
-    
 
-    return fixed_text
+# Lexers are reusable, so only look each one up once
+@functools.lru_cache(maxsize=256)
+def get_lexer(name):
+    try:
+        return get_lexer_by_name(name)
+    except ValueError:
+        return get_lexer_by_name('text')
+
 
 class MyRenderer(HTMLRenderer):
     def __init__(self, post=None):
@@ -164,28 +217,27 @@ class MyRenderer(HTMLRenderer):
         if text.endswith(' '):
             return f'${text}$'
         try:
-            return latex2mathml.converter.convert(text)
+            return convert_latex(text)
         except Exception as e:
             print("LaTeX rendering error")
 
     
     def block_math(self, text):
         try:
-            
-            return latex2mathml.converter.convert(text).replace('display="inline"', 'display="block"')
+            return convert_latex(text).replace('display="inline"', 'display="block"')
         except Exception as e:
             print("LaTeX rendering error")
     
     def block_code(self, code, info=None):
         if info is None:
             info = 'text'
-        try:
-            lexer = get_lexer_by_name(info)
-        except ValueError:
-            lexer = get_lexer_by_name('text')
-        
-        formatter = HtmlFormatter(style='friendly')
-        highlighted_code = highlight(code, lexer, formatter)
+        lexer = get_lexer(info)
+
+        cache_key = (lexer.name, hashlib.sha256(code.encode('utf-8')).hexdigest())
+        highlighted_code = highlight_cache.get(cache_key)
+        if highlighted_code is None:
+            highlighted_code = highlight(code, lexer, code_formatter)
+            highlight_cache.set(cache_key, highlighted_code)
         return highlighted_code
 
 def create_post_aware_markdown(post=None):
@@ -198,12 +250,21 @@ def create_post_aware_markdown(post=None):
         escape=False)
 
 
-@register.simple_tag(takes_context=False)
-def markdown(content, blog=None, post=None, tz=None):
-    content = str(content)
-    if not content:
-        return ''
+def render_fingerprint(blog=None, post=None):
+    # Every input that can change the rendered output of the same content
+    upgraded = bool(blog and blog.user.settings.upgraded)
+    if post is None:
+        post_type = 'none'
+    else:
+        post_type = 'page' if post.is_page else 'post'
+    lang = (post.lang if post else '') or (blog.lang if blog else '')
+    date_format = blog.date_format if blog else ''
 
+    return f"{RENDERER_VERSION}:{int(upgraded)}:{post_type}:{lang}:{date_format}"
+
+
+# The markdown pipeline itself, also run in the render sandbox
+def render_uncached(content, post=None, upgraded=False):
     # Removes old formatted inline LaTeX
     content = replace_inline_latex(content)
     # Find urls with parentheses and escape them
@@ -215,12 +276,74 @@ def markdown(content, blog=None, post=None, tz=None):
         markdown_renderer = create_post_aware_markdown(post=post)
         processed_markup = markdown_renderer(content)
     except TypeError:
-        return ''
+        processed_markup = ''
 
     # If not upgraded remove iframes and js
-    if not blog or not blog.user.settings.upgraded:
+    if processed_markup and not upgraded:
         processed_markup = clean(processed_markup)
 
+    return processed_markup
+
+
+def render_markup(content, blog=None, post=None):
+    cache_key = hashlib.sha256(f"{render_fingerprint(blog, post)}:{content}".encode('utf-8')).hexdigest()
+    processed_markup = render_cache.get(cache_key)
+    if processed_markup is not None:
+        return processed_markup
+
+    upgraded = bool(blog and blog.user.settings.upgraded)
+
+    if render_sandbox.should_sandbox(content):
+        processed_markup = render_sandbox.render(content, post, upgraded)
+        if processed_markup is None:
+            # Not cached, so it's rendered properly once the content changes
+            return render_sandbox.fallback(content)
+    else:
+        start = time.perf_counter()
+        processed_markup = render_uncached(content, post, upgraded)
+        render_sandbox.record_duration(content, time.perf_counter() - start)
+
+    render_cache.set(cache_key, processed_markup)
+    return processed_markup
+
+
+# HTML and render stamp to store on a Post or Blog
+def render_stamp(content, blog=None, post=None):
+    # With a hash of the content, so writes that skip save(), like update() and bulk_update(),
+    # leave a stale stamp rather than stale HTML
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()[:8]
+    return f"{render_fingerprint(blog, post)}:{content_hash}"
+
+
+def render_stored(content, blog=None, post=None):
+    html = render_markup(content, blog, post)
+    # Plain text fallbacks get no stamp, so they're rendered again once the timeout expires
+    stamp = '' if render_sandbox.timed_out(content) else render_stamp(content, blog, post)
+    return html, stamp
+
+
+# Serve the HTML stored on a Post or Blog, only rendering it again if the stamp is stale
+def stored_markup(obj, blog=None, post=None):
+    if obj.render_stamp != render_stamp(str(obj.content), blog, post):
+        old_stamp = obj.render_stamp
+        obj.content_html, obj.render_stamp = render_stored(str(obj.content), blog, post)
+
+        # Skip the save cascade and don't clobber a concurrent save of newer content
+        if obj.pk and obj.render_stamp:
+            type(obj).objects.filter(pk=obj.pk, render_stamp=old_stamp).update(content_html=obj.content_html, render_stamp=obj.render_stamp)
+            if isinstance(obj, Blog):
+                # Cached lookups still hold the old HTML
+                invalidate_hosts((obj.subdomain, obj.domain))
+
+    return obj.content_html
+
+
+@register.simple_tag(takes_context=False)
+def rendered_content(obj, blog=None, post=None, tz=None):
+    processed_markup = stored_markup(obj, blog, post)
+    if not processed_markup:
+        return ''
+
     # Replace {{ xyz }} elements
     if blog:
         processed_markup = excluding_pre(processed_markup, blog, post, tz=tz)
@@ -228,50 +351,90 @@ def markdown(content, blog=None, post=None, tz=None):
     return mark_safe(processed_markup)
 
 
-# Exclude script and style tags from markdown rendering
-def excluding_script(markup, post=None):
-    placeholders = {}
+@register.simple_tag(takes_context=False)
+def markdown(content, blog=None, post=None, tz=None):
+    content = str(content)
+    if not content:
+        return ''
 
-    def placeholder_div(match):
-        key = f"PLACEHOLDER_{len(placeholders)}"
-        print(placeholders)
-        placeholders[key] = match.group(0)
-        return key
+    processed_markup = render_markup(content, blog, post)
+    if not processed_markup:
+        return ''
+
+    # Replace {{ xyz }} elements (not cached since these depend on the time and blog state)
+    if blog:
+        processed_markup = excluding_pre(processed_markup, blog, post, tz=tz)
 
-    markup = re.sub(r'(<script.*?>.*?</script>|<style.*?>.*?</style>)', placeholder_div, markup, flags=re.DOTALL)
+    return mark_safe(processed_markup)
+
+
+def split_blocks(markup, tags):
+    """
+    Splits markup into alternating text and blocks, [text, block, text, ..., text], the same as
+    re.split(r'(<pre.*?>.*?</pre>|<code.*?>.*?</code>)', markup, flags=re.DOTALL) for ('pre', 'code').
+    That regex rescanned the rest of the markup from every unclosed tag.
+    """
+    found = {}
+
+    def find(needle, start):
+        # Searches only move forward, so a result that's still ahead can be reused
+        result = found.get(needle)
+        if result is None or -1 < result < start:
+            result = markup.find(needle, start)
+            found[needle] = result
+        return result
+
+    segments = []
+    pos = 0
+    for match in re.finditer(f"<({'|'.join(tags)})", markup):
+        if match.start() < pos:
+            continue
+        tag_end = find('>', match.end())
+        if tag_end == -1:
+            break
+        close = find(f'</{match.group(1)}>', tag_end + 1)
+        if close == -1:
+            continue
+
+        end = close + len(match.group(1)) + 3
+        segments.append(markup[pos:match.start()])
+        segments.append(markup[match.start():end])
+        pos = end
+
+    segments.append(markup[pos:])
+    return segments
+
+
+# Exclude script and style tags from markdown rendering
+def excluding_script(markup, post=None):
+    segments = split_blocks(markup, ('script', 'style'))
+    placeholders = segments[1::2]
+    # Random so it can't collide with the content, and delimited so 1 can't match inside 10
+    token = f"PLACEHOLDER{uuid.uuid4().hex}"
+    markup = ''.join(segment if i % 2 == 0 else f"{token}x{i // 2}x" for i, segment in enumerate(segments))
 
     markdown_renderer = create_post_aware_markdown(post=post)
     markup = markdown_renderer(markup)
 
-    for key in sorted(placeholders.keys(), reverse=True):
-        markup = markup.replace(key, placeholders[key])
+    if not placeholders:
+        return markup
 
-    return markup
+    # Restore everything in one pass
+    return re.sub(rf"{token}x(\d+)x", lambda match: placeholders[int(match.group(1))], markup)
 
 
 # Replace elements in all but pre and code tags
 def excluding_pre(markup, blog=None, post=None, tz=None):
-    placeholders = {}
-
-    def placeholder_div(match):
-        key = f"PLACEHOLDER_{len(placeholders)}"
-        placeholders[key] = match.group(0)
-        return key
+    if not blog or '{{' not in markup:
+        return markup
 
-    markup = re.sub(r'(<pre.*?>.*?</pre>|<code.*?>.*?</code>)', placeholder_div, markup, flags=re.DOTALL)
+    segments = split_blocks(markup, ('pre', 'code'))
+    replace_directive = directive_replacer(blog, post, tz=tz)
+    for i in range(0, len(segments), 2):
+        if '{{' in segments[i]:
+            segments[i] = DIRECTIVE_PATTERN.sub(replace_directive, segments[i])
 
-    if blog:
-        if post: 
-            markup = element_replacement(markup, blog, post, tz=tz)
-        else:
-            markup = element_replacement(markup, blog, tz=tz)
-    else:
-        markup = element_replacement(markup, tz=tz)
-
-    for key in sorted(placeholders.keys(), reverse=True):
-        markup = markup.replace(key, placeholders[key])
-
-    return markup
+    return ''.join(segments)
 
 
 def apply_filters(posts, tag=None, limit=None, order=None):
@@ -293,96 +456,109 @@ def apply_filters(posts, tag=None, limit=None, order=None):
     return posts
 
 
-def element_replacement(markup, blog, post=None, tz=None):
-    # Match the entire {{ posts ... }} directive, including parameters
-    pattern = r'\{\{\s*posts([^}]*)\}\}'
-    
-    def replace_with_filtered_posts(match):
-        params_str = match.group(1) 
-        tag, limit, order, description, content = None, None, None, False, False
-        
-        # Extract and process parameters one by one
-        param_pattern = r'(tag:([^|}\s][^|}]*)|limit:(\d+)|order:(asc|desc)|description:(True)|content:(True))'
-        params = re.findall(param_pattern, params_str)
-        for param in params:
-            if 'tag:' in param[0]:
-                tag = param[1].strip()
-            elif 'limit:' in param[0]:
-                limit = int(param[2])
-            elif 'order:' in param[0]:
-                order = param[3]
-            elif 'description:' in param[0]:
-                description = param[4] == 'True'
-            # Only show content if injection is on page or homepage
-            elif 'content:' in param[0] and not post or post.is_page:
-                content = param[5] == 'True'
-
-        filtered_posts = apply_filters(blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now(), is_template_draft=False), tag, limit, order)
-        context = {'blog': blog, 'posts': filtered_posts, 'embed': True, 'show_description': description, 'show_content': content, 'tz': tz}
-        return render_to_string('snippets/post_list.html', context)
-
-    # Replace each matched directive with rendered content
-    markup = re.sub(pattern, replace_with_filtered_posts, markup)
-
-    # Date translation replacement
-    current_lang = "en" # translation.get_language()
-    translation.activate(blog.lang)
-    if post:
-        translation.activate(post.lang)
+# One pass over the markup for all {{ directives }}: {{ posts ... }}, {{email-signup}} and {{ name }}.
+# An unclosed {{ posts is skipped up to the next '}' (kept as is), since none of the {{ before it can close.
+DIRECTIVE_PATTERN = re.compile(r'\{\{\s*posts(?:(?P<params>[^}]*+)\}\}|[^}]*+)|\{\{(?: (?P<name>[\w-]+) |(?P<bare>email-signup))\}\}')
 
-    if blog.user.settings.upgraded:
-        markup = markup.replace('{{ email-signup }}', render_to_string('snippets/email_subscribe_form.html'))
-        markup = markup.replace('{{email-signup}}', render_to_string('snippets/email_subscribe_form.html'))
-    else:
-        markup = markup.replace('{{ email-signup }}', '')
-        markup = markup.replace('{{email-signup}}', '')
-
-    markup = markup.replace('{{ blog_title }}', escape(blog.title))
-    markup = markup.replace('{{ blog_description }}', escape(blog.meta_description))
-    markup = markup.replace('{{ blog_created_date }}', format_date(blog.created_date, blog.date_format, blog.lang, tz))
-    markup = markup.replace('{{ blog_last_modified }}', timesince(blog.last_modified))
-    if blog.last_posted:
-        markup = markup.replace('{{ blog_last_posted }}', timesince(blog.last_posted))
-    else:
-        markup = markup.replace('{{ blog_last_posted }}', '')
 
-    markup = markup.replace('{{ tags }}', render_to_string('snippets/blog_tags.html', {"tags": blog.tags, "blog_path": blog.blog_path or "blog"}))
-        
-    markup = markup.replace('{{ blog_link }}', f"{blog.useful_domain}")
+def lists_posts(*contents):
+    # Whether any of contents has a {{ posts }} directive, however it's spaced
+    return any(match.group('params') is not None for content in contents if content for match in DIRECTIVE_PATTERN.finditer(content))
+
+
+POSTS_PARAM_PATTERN = re.compile(r'(tag:([^|}\s][^|}]*)|limit:(\d+)|order:(asc|desc)|description:(True)|content:(True))')
+
+
+def render_posts_directive(params_str, blog, post=None, tz=None):
+    tag, limit, order, description, content = None, None, None, False, False
+
+    # Extract and process parameters one by one
+    params = POSTS_PARAM_PATTERN.findall(params_str)
+    for param in params:
+        if 'tag:' in param[0]:
+            tag = param[1].strip()
+        elif 'limit:' in param[0]:
+            limit = int(param[2])
+        elif 'order:' in param[0]:
+            order = param[3]
+        elif 'description:' in param[0]:
+            description = param[4] == 'True'
+        # Only show content if injection is on page or homepage
+        elif 'content:' in param[0] and not post or post.is_page:
+            content = param[5] == 'True'
+
+    filtered_posts = apply_filters(blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now(), is_template_draft=False), tag, limit, order)
+    context = {'blog': blog, 'posts': filtered_posts, 'embed': True, 'show_description': description, 'show_content': content, 'tz': tz}
+    return render_to_string('snippets/post_list.html', context)
+
+
+def directive_values(blog, post=None, tz=None):
+    # Relative dates are translated into the post (or blog) language
+    lang = (post.lang if post else '') or blog.lang
+
+    def in_lang(func, *args):
+        with translation.override(lang):
+            return func(*args)
+
+    def email_signup():
+        if blog.user.settings.upgraded:
+            return render_to_string('snippets/email_subscribe_form.html')
+        return ''
+
+    values = {
+        'email-signup': email_signup,
+        'blog_title': lambda: escape(blog.title),
+        'blog_description': lambda: escape(blog.meta_description),
+        'blog_created_date': lambda: format_date(blog.created_date, blog.date_format, blog.lang, tz),
+        'blog_last_modified': lambda: in_lang(timesince, blog.last_modified),
+        'blog_last_posted': lambda: in_lang(timesince, blog.last_posted) if blog.last_posted else '',
+        'tags': lambda: in_lang(render_to_string, 'snippets/blog_tags.html', {"tags": blog.tags, "blog_path": blog.blog_path or "blog"}),
+        'blog_link': lambda: f"{blog.useful_domain}",
+    }
 
     if post:
-        markup = markup.replace('{{ post_title }}', escape(post.title))
-        markup = markup.replace('{{ post_description }}', escape(post.meta_description))
-        markup = markup.replace('{{ post_published_date }}', format_date(post.published_date, blog.date_format, blog.lang, tz))
-        last_modified = post.last_modified or timezone.now()
-        markup = markup.replace('{{ post_last_modified }}', timesince(last_modified))
-        markup = markup.replace('{{ post_link }}', f"{blog.useful_domain}/{post.slug}")
+        values.update({
+            'post_title': lambda: escape(post.title),
+            'post_description': lambda: escape(post.meta_description),
+            'post_published_date': lambda: format_date(post.published_date, blog.date_format, blog.lang, tz),
+            'post_last_modified': lambda: in_lang(timesince, post.last_modified or timezone.now()),
+            'post_link': lambda: f"{blog.useful_domain}/{post.slug}",
+        })
 
-    translation.activate(current_lang)
+    return values
 
-    return markup
 
+# Returns a DIRECTIVE_PATTERN replacement function that computes each directive once
+def directive_replacer(blog, post=None, tz=None):
+    values = directive_values(blog, post, tz=tz)
+    rendered = {}
 
-@register.filter
-def clean(markup):
-    cleaned_markup = re.sub(r'<script.*?>.*?</script>', '', markup, flags=re.DOTALL | re.IGNORECASE)
-    
-    cleaned_markup = re.sub(r'\son\w+="[^"]*"', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'\son\w+=\'[^\']*\'', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'\son\w+=\w+', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'(<\w+\s+.*?)(href|src)\s*=\s*["\']?javascript:[^"\']*["\']?', r'\1', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'<(object|embed|form|input|button).*?>', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'</(object|embed|form|input|button)>', '', cleaned_markup, flags=re.IGNORECASE)
-    
-    def iframe_whitelisted(match):
-        src = match.group(2)
-        if any(host in src for host in HOST_WHITELIST):
+    def replace_directive(match):
+        if match.group('params') is not None:
+            return render_posts_directive(match.group('params'), blog, post, tz=tz)
+
+        name = match.group('name') or match.group('bare')
+        if name not in values:
             return match.group(0)
-        return ''
 
-    cleaned_markup = re.sub(r'(<iframe.*?src=["\'])([^"\']*)(["\'].*?>.*?</iframe>)', iframe_whitelisted, cleaned_markup, flags=re.DOTALL | re.IGNORECASE)
+        if name not in rendered:
+            rendered[name] = values[name]()
+        return rendered[name]
+
+    return replace_directive
+
 
-    return cleaned_markup
+def element_replacement(markup, blog, post=None, tz=None):
+    # Most content has no directives, skip building anything
+    if '{{' not in markup:
+        return markup
+
+    return DIRECTIVE_PATTERN.sub(directive_replacer(blog, post, tz=tz), markup)
+
+
+@register.filter
+def clean(markup):
+    return sanitize(markup)
 
 
 @register.filter
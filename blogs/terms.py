@@ -0,0 +1,96 @@
+from blogs.cache import LRUCache
+
+from collections import deque
+import hashlib
+
+
+# Compiled matchers keyed by the terms they match, so one is only compiled again when the terms change
+term_matchers = LRUCache('term_matchers', max_entries=4)
+
+
+class TermMatcher:
+    """
+    Aho-Corasick automaton counting how often each of many terms shows up in a text, in one pass
+    over it. Terms are weighted, a term given more than once adds its weights together.
+
+    Counts are what str.count gives for each term on its own: case-insensitive and not
+    overlapping another match of the same term, though matches of different terms can overlap.
+    """
+
+    def __init__(self, weighted_terms):
+        self.terms = []
+        self.weights = []
+        index = {}
+        for term, weight in weighted_terms:
+            term = term.lower()
+            if not term:
+                continue
+            if term not in index:
+                index[term] = len(self.terms)
+                self.terms.append(term)
+                self.weights.append(0)
+            self.weights[index[term]] += weight
+        self.lengths = [len(term) for term in self.terms]
+
+        # A trie of the terms, with the terms ending at each state
+        children = [{}]
+        matches = [[]]
+        for i, term in enumerate(self.terms):
+            state = 0
+            for char in term:
+                if char not in children[state]:
+                    children[state][char] = len(children)
+                    children.append({})
+                    matches.append([])
+                state = children[state][char]
+            matches[state].append(i)
+
+        # Breadth first, each state falls back to the longest suffix of it that's also in the trie,
+        # and takes on its transitions and matches. Scanning is then one dict lookup per character.
+        self.transitions = [dict(children[0])] + [None] * (len(children) - 1)
+        self.matches = matches
+        queue = deque((state, 0) for state in children[0].values())
+        while queue:
+            state, fallback = queue.popleft()
+            self.transitions[state] = {**self.transitions[fallback], **children[state]}
+            self.matches[state] = matches[state] + self.matches[fallback]
+            for char, child in children[state].items():
+                queue.append((child, self.transitions[fallback].get(char, 0)))
+
+    def scan(self, text):
+        transitions = self.transitions
+        matches = self.matches
+        lengths = self.lengths
+        counts = [0] * len(self.terms)
+        # Where the last counted match of each term ended, so the next can't overlap it
+        ends = [0] * len(self.terms)
+
+        state = 0
+        end = 0
+        for char in text.lower():
+            end += 1
+            state = transitions[state].get(char, 0)
+            if matches[state]:
+                for i in matches[state]:
+                    if end - lengths[i] >= ends[i]:
+                        counts[i] += 1
+                        ends[i] = end
+        return counts
+
+    def counts(self, text):
+        """How often each term shows up in text"""
+        return {term: count for term, count in zip(self.terms, self.scan(text)) if count}
+
+    def score(self, text):
+        """Every match of a term in text times its weight"""
+        return sum(count * weight for count, weight in zip(self.scan(text), self.weights))
+
+
+def term_matcher(weighted_terms):
+    """The compiled TermMatcher for weighted_terms, a list of (term, weight)"""
+    key = hashlib.sha256(repr(weighted_terms).encode('utf-8')).hexdigest()
+    matcher = term_matchers.get(key)
+    if matcher is None:
+        matcher = TermMatcher(weighted_terms)
+        term_matchers.set(key, matcher)
+    return matcher
@@ -0,0 +1,457 @@
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.core.cache import cache as django_cache
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse
+from django.test import Client, SimpleTestCase, TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from blogs import cloudflare, page_cache
+from blogs.benchmarks import adversarial, lookups, pages, purges, saves
+from blogs.benchmarks.rendering import code_heavy_markup, legacy_excluding_pre
+from blogs.models import Blog, Comment, PersistentStore, Post, batched_blog_updates
+from blogs.templatetags.custom_tags import excluding_pre
+
+from contextlib import nullcontext
+from datetime import timedelta
+import itertools
+from unittest import mock
+import math
+import os
+import threading
+import time
+import unittest
+
+
+class ExcludingPreTests(SimpleTestCase):
+    def setUp(self):
+        self.blog = Blog(title='Mine', subdomain='mine', lang='en')
+
+    def assertSameAsLegacy(self, markup):
+        self.assertEqual(excluding_pre(markup, self.blog), legacy_excluding_pre(markup, self.blog))
+
+    def test_code_heavy_markup(self):
+        self.assertSameAsLegacy(code_heavy_markup(50))
+
+    def test_directives_outside_blocks(self):
+        self.assertEqual(
+            excluding_pre('<pre><code>{{ blog_title }}</code></pre> {{ blog_title }}', self.blog),
+            '<pre><code>{{ blog_title }}</code></pre> Mine',
+        )
+
+    def test_nested_blocks(self):
+        self.assertSameAsLegacy('<pre><code>{{ blog_title }}</code></pre> {{ blog_title }}')
+        self.assertSameAsLegacy('<pre>outer <pre>inner {{ blog_title }}</pre> {{ blog_title }}</pre> {{ blog_title }}')
+        self.assertSameAsLegacy('<code>outer <pre>{{ blog_title }}</code></pre> {{ blog_title }}')
+
+    def test_unclosed_blocks(self):
+        self.assertSameAsLegacy('<code>a</code><pre>{{ blog_title }} unclosed')
+        self.assertSameAsLegacy('<pre>{{ blog_title }} unclosed <code>{{ blog_title }}</code> {{ blog_title }}')
+        self.assertSameAsLegacy('<code>{{ blog_title }}</pre> {{ blog_title }}')
+        self.assertSameAsLegacy('<pre class="unterminated {{ blog_title }}')
+        self.assertSameAsLegacy('<code>{{ blog_title </code>}}')
+
+    def test_directives_in_code_spans(self):
+        self.assertSameAsLegacy('inline <code>{{ posts }}</code> and <code>{{email-signup}}</code>{{ blog_title }}')
+        self.assertSameAsLegacy('<code class="language-html">{{ posts limit:3 }}</code>{{ blog_title }}')
+
+    def test_attributes_and_similar_tags(self):
+        self.assertSameAsLegacy('<pre\n class="x">{{ blog_title }}</pre>{{ blog_title }}')
+        self.assertSameAsLegacy('<codex>{{ blog_title }}</codex></code>{{ blog_title }}')
+
+    def test_uppercase_tags(self):
+        # Neither matched uppercase tags, markdown only writes lowercase ones
+        self.assertSameAsLegacy('<PRE>{{ blog_title }}</PRE> <Code>{{ blog_title }}</Code>')
+        self.assertSameAsLegacy('<PRE>{{ blog_title }}</pre> {{ blog_title }}')
+
+    def test_literal_placeholders(self):
+        # The legacy version swapped text that looked like its placeholders for blocks, it's left alone now
+        self.assertEqual(
+            excluding_pre('<code a="b">{{ blog_title }} PLACEHOLDER_0</code> PLACEHOLDER_0 {{ blog_title }}', self.blog),
+            '<code a="b">{{ blog_title }} PLACEHOLDER_0</code> PLACEHOLDER_0 Mine',
+        )
+        self.assertEqual(
+            excluding_pre('PLACEHOLDER_1 <code>x</code><code>y</code> {{ blog_title }}', self.blog),
+            'PLACEHOLDER_1 <code>x</code><code>y</code> Mine',
+        )
+
+    def test_without_blog_or_directives(self):
+        self.assertEqual(excluding_pre('<p>{{ blog_title }}</p>'), '<p>{{ blog_title }}</p>')
+        self.assertEqual(excluding_pre('<pre>plain</pre>', self.blog), '<pre>plain</pre>')
+
+
+class PostSaveTests(TestCase):
+    # A save updates the post and counts its upvotes. At commit the blogs are loaded in one
+    # query, then each takes seven more to update, however many of its posts were saved.
+
+    @classmethod
+    def setUpTestData(cls):
+        PersistentStore.load()
+        cls.blogs = saves.seed(blogs=3, posts=5)
+
+    def setUp(self):
+        posts = Post.objects.select_related('blog__user__settings').order_by('pk')
+        self.posts = [list(posts.filter(blog=blog)) for blog in self.blogs]
+
+    def save(self, posts, wrapper=nullcontext):
+        # Commit hooks run as the test's transaction would have committed
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            with wrapper():
+                for post in posts:
+                    post.save()
+        return {query['sql'] for query in queries if query['sql'].startswith('UPDATE "blogs_blog"')}
+
+    def test_single_save(self):
+        with self.assertNumQueries(2 + 1 + 7):
+            updates = self.save(self.posts[0][:1])
+        self.assertEqual(len(updates), 1)
+
+    def test_saves_in_transaction(self):
+        # And the savepoint
+        with self.assertNumQueries(2 + 5 * 2 + 1 + 7):
+            updates = self.save(self.posts[0], transaction.atomic)
+        self.assertEqual(len(updates), 1)
+
+    def test_batched_saves(self):
+        with self.assertNumQueries(5 * 2 + 1 + 7):
+            updates = self.save(self.posts[0], batched_blog_updates)
+        self.assertEqual(len(updates), 1)
+
+    def test_batched_saves_across_blogs(self):
+        every_blog = [post for blog_posts in zip(*self.posts) for post in blog_posts]
+        with self.assertNumQueries(15 * 2 + 1 + 3 * 7):
+            updates = self.save(every_blog, batched_blog_updates)
+        self.assertEqual(len(updates), 3)
+
+    def test_nested_batches(self):
+        with self.assertNumQueries(4 * 2 + 1 + 7), self.captureOnCommitCallbacks(execute=True):
+            with batched_blog_updates():
+                with batched_blog_updates():
+                    for post in self.posts[0][:2]:
+                        post.save()
+                for post in self.posts[0][2:4]:
+                    post.save()
+
+    def test_rolled_back_saves(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.posts[0][0].save()
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+
+        # The rolled back blog isn't updated along with the next one saved
+        updates = self.save(self.posts[1][:1])
+        self.assertEqual(len(updates), 1)
+        self.assertIn(f'"blogs_blog"."id" = {self.blogs[1].pk}', updates.pop())
+
+    def test_rolled_back_savepoints(self):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.posts[0][0].save()
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    self.posts[0][1].save()
+                    self.posts[1][0].save()
+                    raise RuntimeError
+                with transaction.atomic():
+                    self.posts[2][0].save()
+
+        # Blogs saved outside the savepoint that rolled back are updated once, the other not at all
+        updated = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "blogs_blog"')]
+        self.assertEqual(len(updated), 2)
+        self.assertFalse(any(f'"blogs_blog"."id" = {self.blogs[1].pk}' in update for update in updated))
+
+
+class AdversarialRenderTests(SimpleTestCase):
+    """The adversarial corpus renders within each function's budget, every case in a forked child"""
+
+    def assertWithinBudgets(self, function_name):
+        function = adversarial.functions()[function_name]
+        budget = adversarial.BUDGETS[function_name]
+        for input_name, content in adversarial.corpus().items():
+            with self.subTest(input=input_name):
+                elapsed = adversarial.run_case(function, content, timeout=max(budget * 4, 5000) / 1000)
+                self.assertIsNotNone(elapsed, f'{function_name}({input_name}) timed out or crashed')
+                self.assertLessEqual(elapsed, budget)
+
+    def test_fix_links(self):
+        self.assertWithinBudgets('fix_links')
+
+    def test_replace_inline_latex(self):
+        self.assertWithinBudgets('replace_inline_latex')
+
+    def test_unmark(self):
+        self.assertWithinBudgets('unmark')
+
+    def test_clean(self):
+        self.assertWithinBudgets('clean')
+
+    def test_excluding_pre(self):
+        self.assertWithinBudgets('excluding_pre')
+
+    # Over a minute, skip it with --exclude-tag slow
+    @tag('slow')
+    def test_markdown(self):
+        self.assertWithinBudgets('markdown')
+
+
+@unittest.skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'Reads SQLite and Postgres query plans')
+class HostLookupPlanTests(TestCase):
+    """Blogs are looked up by host with an index search, in SQLite here and Postgres in production"""
+
+    @classmethod
+    def setUpTestData(cls):
+        lookups.seed(blogs=500)
+
+    def test_host_columns_are_indexed(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Blog._meta.db_table).values()
+        indexed = {tuple(constraint['columns']) for constraint in constraints if constraint['index'] or constraint['unique']}
+        self.assertIn(('subdomain',), indexed)
+        self.assertIn(('normalized_domain',), indexed)
+
+    def test_lookups_use_index(self):
+        for name in ('subdomain', 'domain'):
+            with self.subTest(lookup=name):
+                plan = lookups.query_plan(lookups.lookups()[name]())
+                self.assertTrue(lookups.uses_index(plan), plan)
+
+    def test_legacy_lookups_scan(self):
+        # iexact is LIKE in SQLite and UPPER() of the column in Postgres, which no index serves, so the check tells them apart
+        for name in ('legacy_subdomain', 'legacy_domain'):
+            with self.subTest(lookup=name):
+                plan = lookups.query_plan(lookups.lookups()[name]())
+                self.assertFalse(lookups.uses_index(plan), plan)
+
+
+class BlogDomainTests(TestCase):
+    """A domain another blog has, in any case or with www., is turned away"""
+
+    @classmethod
+    def setUpTestData(cls):
+        lookups.seed(blogs=2)
+
+    def setUp(self):
+        self.owner, self.other = Blog.objects.order_by('pk')
+        self.other.custom_styles = 'body { font-family: sans-serif; }'
+
+    def test_own_domain_is_clean(self):
+        self.owner.clean()
+
+    def test_taken_domain_is_rejected(self):
+        self.other.domain = 'WWW.Lookup0.com'
+        with self.assertRaises(ValidationError):
+            self.other.clean()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.other.save()
+
+    def test_blog_that_lost_its_domain_still_saves(self):
+        # Normalizing the domains left it with one another blog owns
+        Blog.objects.filter(pk=self.other.pk).update(domain='www.lookup0.com', normalized_domain=None)
+        blog = Blog.objects.get(pk=self.other.pk)
+        blog.custom_styles = self.other.custom_styles
+        blog.title = 'Renamed'
+        blog.save()
+        blog.refresh_from_db()
+        self.assertEqual(blog.title, 'Renamed')
+        self.assertIsNone(blog.normalized_domain)
+
+
+class CloudflarePurgeTests(TestCase):
+    """Purges go to a local stub standing in for Cloudflare, sent when the tests flush them"""
+
+    @classmethod
+    def setUpTestData(cls):
+        purges.seed(blogs=40)
+
+    def setUp(self):
+        self.posts = list(Post.objects.filter(uid__startswith='purge').select_related('blog'))
+        self.server = purges.StubPurgeServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+
+        environment = {
+            'ENVIRONMENT': 'test',
+            'CLOUDFLARE_API_URL': self.server.url,
+            'CLOUDFLARE_API_KEY': 'key',
+            'CLOUDFLARE_EMAIL': 'test@example.com',
+            'CLOUDFLARE_ZONE_ID': 'zone',
+        }
+        for patch in (mock.patch.dict(os.environ, environment), mock.patch.object(cloudflare, 'PURGE_WINDOW', 60)):
+            # The worker thread waits out the window, so only flush sends anything
+            patch.start()
+            self.addCleanup(patch.stop)
+        cloudflare.pending.clear()
+        self.addCleanup(cloudflare.pending.clear)
+
+    def comment(self, post):
+        Comment(post=post, user_id=post.blog.user_id, content='Hello').save()
+
+    def test_saves_dont_wait_for_purges(self):
+        start = time.perf_counter()
+        with self.captureOnCommitCallbacks(execute=True):
+            for post in self.posts:
+                self.comment(post)
+        self.assertLess(time.perf_counter() - start, purges.STUB_LATENCY)
+        self.assertEqual(self.server.requests, [])
+
+    def test_comments_purge_their_posts_in_batches(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for post in self.posts * 3:
+                self.comment(post)
+        cloudflare.flush()
+
+        self.assertEqual(self.server.purged(), {cloudflare.post_tag(post.blog_id, post.pk) for post in self.posts})
+        self.assertEqual(len(self.server.requests), math.ceil(len(self.posts) / cloudflare.MAX_TAGS_PER_PURGE))
+        self.assertTrue(all(len(batch) <= cloudflare.MAX_TAGS_PER_PURGE for batch in self.server.requests))
+
+    def test_rolled_back_saves_dont_purge(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.comment(self.posts[0])
+                raise RuntimeError
+        cloudflare.flush()
+        self.assertEqual(self.server.requests, [])
+
+    def test_taking_a_post_off_discover_purges_it(self):
+        for field, post in zip(('make_discoverable', 'publish'), self.posts):
+            post = Post.objects.get(pk=post.pk)
+            setattr(post, field, False)
+            with self.captureOnCommitCallbacks(execute=True):
+                post.save()
+            cloudflare.flush()
+            self.assertIn(cloudflare.DISCOVER_TAG, self.server.purged())
+            self.server.requests.clear()
+
+            # Off it before and after, so the discover feed is left alone
+            with self.captureOnCommitCallbacks(execute=True):
+                post.save()
+            cloudflare.flush()
+            self.assertNotIn(cloudflare.DISCOVER_TAG, self.server.purged())
+
+    def test_failed_purge_is_retried(self):
+        blog = self.posts[0].blog
+        self.server.fail_next = 1
+        with self.captureOnCommitCallbacks(execute=True):
+            blog.invalidate_cloudflare_cache()
+        cloudflare.flush()
+        self.assertEqual(self.server.requests, [])
+        cloudflare.flush()
+        self.assertEqual(self.server.requests, [[blog.subdomain]])
+
+    def test_failed_purge_is_given_up_on(self):
+        self.server.fail_next = cloudflare.MAX_ATTEMPTS
+        with self.captureOnCommitCallbacks(execute=True):
+            self.posts[0].blog.invalidate_cloudflare_cache()
+        for _ in range(cloudflare.MAX_ATTEMPTS + 1):
+            cloudflare.flush()
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(cloudflare.pending, {})
+
+
+@override_settings(PAGE_CACHE=True)
+class PageCacheTests(TestCase):
+    """Public blog pages are served from the page cache, revalidated and sent compressed"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.blog = pages.seed(posts=5)
+
+    def setUp(self):
+        patches = (
+            mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'lh.co'}),
+            # Validators are only sent with a shared page version. In one process the local cache is shared.
+            mock.patch('blogs.page_cache.shared_cache_enabled', return_value=True),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        page_cache.page_cache.clear()
+        django_cache.clear()
+        self.client = Client()
+        self.requests = itertools.count()
+
+    def get(self, path='/', **headers):
+        return pages.page_request(self.client, path, next(self.requests), **headers)
+
+    def test_cache_hit_without_queries(self):
+        self.assertEqual(self.get()['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            response = self.get()
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+
+    def test_purge_drops_pages(self):
+        self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            page_cache.purge_blog_pages(self.blog.pk)
+        self.assertEqual(self.get()['X-Page-Cache'], 'miss')
+
+    def test_matching_etag(self):
+        etag = self.get('/post-1/')['ETag']
+        self.assertEqual(self.get('/post-1/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_etag_of_another_page(self):
+        etag = self.get('/')['ETag']
+        response = self.get('/post-1/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_purged_etag(self):
+        etag = self.get('/post-1/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            page_cache.purge_blog_pages(self.blog.pk)
+        self.assertEqual(self.get('/post-1/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_edge_keeps_pages(self):
+        # Browsers ask every time, Cloudflare holds on to the page until it's purged by tag
+        response = self.get()
+        self.assertEqual(response['Cache-Control'], f'public, max-age=0, s-maxage={settings.PAGE_CACHE_TIMEOUT}')
+        self.assertIn(cloudflare.index_tag(self.blog.pk), response['Cache-Tag'])
+
+    def test_encoding_by_accept_encoding(self):
+        for accept_encoding, encoding in (('gzip, deflate, br', 'br' if page_cache.brotli else 'gzip'), ('gzip', 'gzip'), ('identity', None)):
+            with self.subTest(accept_encoding=accept_encoding):
+                # Stored by the first, served from the cache by the second
+                for _ in range(2):
+                    response = self.get(HTTP_ACCEPT_ENCODING=accept_encoding)
+                    self.assertEqual(response.get('Content-Encoding'), encoding)
+                    self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_post_pages_are_the_same_for_everyone(self):
+        response = self.get('/post-1/')
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertNotIn(settings.CSRF_COOKIE_NAME, response.cookies)
+        self.assertNotIn(b'csrfmiddlewaretoken', response.content)
+
+    def test_pages_with_cookies_arent_stored(self):
+        response = HttpResponse('Hello')
+        self.assertTrue(page_cache.cacheable(response))
+        response.set_cookie(settings.CSRF_COOKIE_NAME, 'token')
+        self.assertFalse(page_cache.cacheable(response))
+
+    def test_visitor_state(self):
+        post = Post.objects.get(blog=self.blog, slug='post-1')
+        Post.objects.filter(pk=post.pk).update(upvotes=3)
+        response = self.get(f'/visitor-state/{post.uid}/')
+        self.assertEqual(response.json(), {'upvotes': 3, 'upvoted': False, 'reported': False})
+        self.assertEqual(response['Cache-Control'], 'private, no-store')
+
+    def test_visitor_state_of_unpublished_posts(self):
+        draft = Post.objects.get(blog=self.blog, slug='post-2')
+        Post.objects.filter(pk=draft.pk).update(publish=False)
+        scheduled = Post.objects.get(blog=self.blog, slug='post-3')
+        Post.objects.filter(pk=scheduled.pk).update(published_date=timezone.now() + timedelta(days=1))
+        for post in (draft, scheduled):
+            with self.subTest(post=post.slug):
+                self.assertEqual(self.get(f'/visitor-state/{post.uid}/').status_code, 404)
+
+    def test_visitor_state_of_another_blog(self):
+        other = saves.seed(blogs=1, posts=1)[0]
+        post = Post.objects.get(blog=other)
+        self.assertEqual(self.get(f'/visitor-state/{post.uid}/').status_code, 404)
+
+    @unittest.skipUnless(page_cache.brotli, 'Pages are only stored gzipped without brotli')
+    def test_encoding_by_quality(self):
+        for accept_encoding, encoding in (('br;q=0.1, gzip', 'gzip'), ('gzip;q=0.5, br;q=0.8', 'br'), ('gzip;q=0.5, br;q=0.5', 'br'), ('br;q=0, gzip', 'gzip')):
+            with self.subTest(accept_encoding=accept_encoding):
+                self.assertEqual(self.get(HTTP_ACCEPT_ENCODING=accept_encoding).get('Content-Encoding'), encoding)
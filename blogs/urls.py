@@ -96,6 +96,7 @@ urlpatterns = [
     path('robots.txt', blog.robots, name='robots'),
     path('public-analytics/', blog.public_analytics, name="public_analytics"),
     path('upvote/<uid>/', blog.upvote, name='upvote'),
+    path('visitor-state/<uid>/', blog.visitor_state, name='visitor_state'),
     path('comment/<uid>/', blog.add_comment, name='add_comment'),
     path('comment/delete/<int:comment_id>/', blog.delete_comment, name='delete_comment'),
     path('report-dangerous/<uid>/', blog.report_dangerous, name='report_dangerous'),
@@ -1,4 +1,6 @@
-from django.http import HttpResponse
+from django.db import IntegrityError
+from django.db.models import Exists, OuterRef, Value
+from django.http import HttpResponse, JsonResponse
 from django.http.response import Http404
 from django.shortcuts import get_object_or_404, render, redirect
 from django.views.decorators.csrf import csrf_exempt
@@ -6,7 +8,11 @@ from django.utils import timezone
 from django.utils.text import slugify
 
 from blogs.models import Blog, Post, Upvote, Comment, DangerousReport
+from blogs.cloudflare import DISCOVER_TAG, index_tag, post_tag, tag_response
 from blogs.helpers import salt_and_hash, unmark
+from blogs.hosts import cached_blog, known_domain, main_site_hosts, normalize_domain
+from blogs.page_cache import cached_page, conditional_page
+from blogs.templatetags.custom_tags import lists_posts
 from blogs.views.analytics import render_analytics
 from blogs.views.discover import get_base_query
 
@@ -15,9 +21,22 @@ import tldextract
 import random
 
 def resolve_address(request):
+    # Resolved once per request, as the view and context processors all ask for it
+    if not hasattr(request, 'resolved_blog'):
+        try:
+            request.resolved_blog = lookup_address(request)
+        except Http404 as error:
+            request.resolved_blog = error
+
+    if isinstance(request.resolved_blog, Http404):
+        raise request.resolved_blog
+    return request.resolved_blog
+
+
+def lookup_address(request):
     http_host = request.get_host()
 
-    sites = os.getenv('MAIN_SITE_HOSTS').split(',')
+    sites = main_site_hosts()
 
     # forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR', '')
     # if forwarded_for:
@@ -28,28 +47,38 @@ def resolve_address(request):
         return None
     elif any(site in http_host for site in sites):
         # Subdomained blog
-        subdomain = tldextract.extract(http_host).subdomain
-        
-        if request.COOKIES.get('admin_passport') == os.getenv('ADMIN_PASSPORT'):
-            return get_object_or_404(Blog.objects.select_related('user').select_related('user__settings'), subdomain__iexact=subdomain)
-        else:
-            return get_object_or_404(Blog.objects.select_related('user').select_related('user__settings'), subdomain__iexact=subdomain, user__is_active=True)
+        admin_passport = os.getenv('ADMIN_PASSPORT')
+        if admin_passport and request.COOKIES.get('admin_passport') == admin_passport:
+            # Staff can see blocked blogs, which aren't cached
+            subdomain = tldextract.extract(http_host).subdomain.lower()
+            return get_object_or_404(Blog.objects.select_related('user').select_related('user__settings'), subdomain=subdomain)
+
+        def lookup():
+            # Subdomains are stored lowercase
+            subdomain = tldextract.extract(http_host).subdomain.lower()
+            return Blog.objects.select_related('user').select_related('user__settings').filter(subdomain=subdomain, user__is_active=True).first()
+
+        blog = cached_blog(f'subdomain:{http_host}', lookup)
+        if not blog:
+            raise Http404('No blog with this subdomain')
+        return blog
     else:
         # Custom domain blog
         return get_blog_with_domain(http_host)
 
 
+def find_blog_with_domain(domain):
+    # Matches regardless of case and www.
+    return Blog.objects.select_related('user').select_related('user__settings').filter(normalized_domain=normalize_domain(domain), user__is_active=True).first()
+
+
 def get_blog_with_domain(domain):
     if not domain:
         return False
-    try:
-        return Blog.objects.get(domain=domain, user__is_active=True)
-    except Blog.DoesNotExist:
-        # Handle www subdomain if necessary
-        if 'www.' in domain:
-            return get_object_or_404(Blog, domain__iexact=domain.replace('www.', ''), user__is_active=True)
-        else:
-            return get_object_or_404(Blog, domain__iexact=f'www.{domain}', user__is_active=True)
+    blog = cached_blog(f'domain:{domain}', lambda: find_blog_with_domain(domain))
+    if not blog:
+        raise Http404('No blog with this domain')
+    return blog
 
 
 @csrf_exempt
@@ -57,7 +86,8 @@ def ping(request):
     domain = request.GET.get("domain", None)
     
     try:
-        if get_blog_with_domain(domain):
+        # Most pings are for hosts without a blog, from scanners, which the index answers without a query
+        if domain and known_domain(domain) and get_blog_with_domain(domain):
             print('Ping! Found correct blog. Issuing certificate.')
             return HttpResponse('Ping', status=200)
     except:
@@ -67,6 +97,8 @@ def ping(request):
     return HttpResponse('Invalid domain', status=422)
 
 
+@conditional_page
+@cached_page
 def home(request):
     # Handle docs subdomain
     if request.get_host() in ['docs.lh.co', 'docs.vibera.dev']:
@@ -86,15 +118,16 @@ def home(request):
         while len(showcase_drops) < 4:
             showcase_drops.append(None)
         
-        return render(request, 'landing.html', {
+        response = render(request, 'landing.html', {
             'showcase_drops': showcase_drops
         })
+        return tag_response(response, DISCOVER_TAG)
 
     all_posts = blog.posts.filter(publish=True, published_date__lte=timezone.now(), is_page=False, is_template_draft=False).order_by('-published_date')
 
     meta_description = blog.meta_description or unmark(blog.content)[:157] + '...'
     
-    return render(
+    response = render(
         request,
         'home.html',
         {
@@ -103,6 +136,7 @@ def home(request):
             'meta_description': meta_description
         }
     )
+    return tag_response(response, blog.subdomain, index_tag(blog.pk))
 
 
 def posts(request, blog):
@@ -138,7 +172,7 @@ def posts(request, blog):
 
     blog_path_title = blog.blog_path.replace('-', ' ').capitalize() or 'Blog'
 
-    return render(
+    response = render(
         request,
         'posts.html',
         {
@@ -153,6 +187,7 @@ def posts(request, blog):
             'blog_path_title': blog_path_title
         }
     )
+    return tag_response(response, blog.subdomain, index_tag(blog.pk))
 
 
 def docs_router(request, slug):
@@ -197,6 +232,8 @@ def docs_router(request, slug):
 
 
 @csrf_exempt
+@conditional_page
+@cached_page
 def post(request, slug):
     # Handle docs subdomain first
     if request.get_host() in ['docs.lh.co', 'docs.vibera.dev']:
@@ -233,10 +270,6 @@ def post(request, slug):
 
             return render(request, '404.html', {'blog': blog}, status=404)
     
-    # Check if upvoted
-    hash_id = salt_and_hash(request, 'year')
-    upvoted = post.upvote_set.filter(hash_id=hash_id).exists()
-
     meta_description = post.meta_description or unmark(post.content)[:157] + '...'
     full_path = f'{blog.useful_domain}/{post.slug}/'
     canonical_url = full_path
@@ -269,7 +302,6 @@ def post(request, slug):
         'canonical_url': canonical_url,
         'meta_description': meta_description,
         'meta_image': post.meta_image or blog.meta_image,
-        'upvoted': upvoted,
         'user_has_reported': post.user_has_active_report(request.user),
         'user_latest_report': user_latest_report,
         'preview': is_preview,
@@ -292,11 +324,45 @@ def post(request, slug):
     response = render(request, 'post.html', context)
 
     if post.publish and not request.GET.get('token'):
-        response['Cache-Tag'] = blog.subdomain
+        tags = [blog.subdomain, post_tag(blog.pk, post.pk)]
+        # Post lists can be in the post or in the blog's nav, header or footer on every page
+        if lists_posts(post.content, blog.nav, blog.header_directive, blog.footer_directive):
+            tags.append(index_tag(blog.pk))
+        tag_response(response, *tags)
         
     return response
 
 
+def visitor_state(request, uid):
+    """
+    Whether the visitor has upvoted or reported a post, and its upvotes. Post pages render the
+    same for every visitor so they can be cached, and fill this in after they load.
+    """
+    blog = resolve_address(request)
+    if not blog:
+        raise Http404('Blog not found')
+
+    hash_id = salt_and_hash(request, 'year')
+    # Published posts of this blog only, as post() shows them
+    posts = Post.objects.filter(blog=blog, uid=uid, publish=True, published_date__lte=timezone.now()).annotate(
+        upvoted=Exists(Upvote.objects.filter(post=OuterRef('pk'), hash_id=hash_id)),
+    )
+    if request.user.is_authenticated:
+        posts = posts.annotate(
+            reported=Exists(DangerousReport.objects.filter(post=OuterRef('pk'), user=request.user, deleted=False)),
+        )
+    else:
+        posts = posts.annotate(reported=Value(False))
+
+    state = posts.values('upvotes', 'upvoted', 'reported').first()
+    if state is None:
+        raise Http404('Post not found')
+
+    response = JsonResponse(state)
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
 @csrf_exempt
 def upvote(request, uid):
     hash_id = salt_and_hash(request, 'year')
@@ -305,13 +371,10 @@ def upvote(request, uid):
         post = get_object_or_404(Post, uid=uid)
         print("Upvoting", post)
         try:
-            upvote, created = Upvote.objects.get_or_create(post=post, hash_id=hash_id)
-        
-            if created:
-                return HttpResponse(f'Upvoted {post.title}')
+            Upvote(post=post, hash_id=hash_id).save()
+        except IntegrityError:
             raise Http404('Duplicate upvote')
-        except Upvote.MultipleObjectsReturned:
-            return HttpResponse(f'Upvoted {post.title}')
+        return HttpResponse(f'Upvoted {post.title}')
     raise Http404("Someone's doing something dodgy ʕ •`ᴥ•´ʔ")
 
 
@@ -330,6 +393,8 @@ def not_found(request, *args, **kwargs):
     return render(request, '404.html', status=404)
 
 
+@conditional_page
+@cached_page
 def sitemap(request):
     blog = resolve_address(request)
     if not blog:
@@ -340,15 +405,19 @@ def sitemap(request):
     except AttributeError:
         posts = []
 
-    return render(request, 'sitemap.xml', {'blog': blog, 'posts': posts}, content_type='text/xml')
+    response = render(request, 'sitemap.xml', {'blog': blog, 'posts': posts}, content_type='text/xml')
+    return tag_response(response, blog.subdomain, index_tag(blog.pk))
 
 
+@conditional_page
+@cached_page
 def robots(request):
     blog = resolve_address(request)
     if not blog:
         return not_found(request)
 
-    return render(request, 'robots.txt',  {'blog': blog}, content_type="text/plain")
+    response = render(request, 'robots.txt',  {'blog': blog}, content_type="text/plain")
+    return tag_response(response, blog.subdomain)
 
 
 @csrf_exempt
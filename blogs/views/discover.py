@@ -5,6 +5,7 @@ from django.db.models import Q
 from django.utils import timezone
 from django.db.models.functions import Length
 
+from blogs.cloudflare import DISCOVER_TAG, tag_response
 from blogs.models import Post
 from blogs.helpers import clean_text
 
@@ -127,7 +128,7 @@ def discover(request):
     # Get popular tags and tools for the filter dropdown
     popular_tags, popular_tools = get_popular_tags_and_tools()
 
-    return render(request, "discover.html", {
+    response = render(request, "discover.html", {
         "lang": lang,
         "available_languages": get_available_languages(),
         "posts": posts,
@@ -141,6 +142,7 @@ def discover(request):
         "popular_tags": popular_tags,
         "popular_tools": popular_tools,
     })
+    return tag_response(response, DISCOVER_TAG)
 
 
 def get_available_languages():
@@ -237,7 +239,7 @@ def feed(request):
     # Generate the feed string
     feed_str = feed_method(pretty=True)
 
-    return HttpResponse(feed_str, content_type=f"application/xml")
+    return tag_response(HttpResponse(feed_str, content_type=f"application/xml"), DISCOVER_TAG)
 
 
 def search(request):
@@ -1,8 +1,10 @@
 from django.http import HttpResponse
 from django.utils import timezone
 
+from blogs.cloudflare import feed_tag, tag_response
 from blogs.helpers import unmark
-from blogs.templatetags.custom_tags import markdown
+from blogs.page_cache import cached_page, conditional_page
+from blogs.templatetags.custom_tags import excluding_pre, stored_markup
 from blogs.views.blog import not_found, resolve_address
 
 from feedgen.feed import FeedGenerator
@@ -13,6 +15,8 @@ def clean_string(s):
     return re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', s)
 
 
+@conditional_page
+@cached_page
 def feed(request):
     tag = request.GET.get('q')
 
@@ -32,8 +36,7 @@ def feed(request):
         raise e
     
     response = HttpResponse(feed, content_type='application/xml')
-    response['Cache-Tag'] = blog.subdomain
-    return response
+    return tag_response(response, blog.subdomain, feed_tag(blog.pk))
 
 
 def generate_feed(blog, feed_type="atom", tag=None):
@@ -62,9 +65,9 @@ def generate_feed(blog, feed_type="atom", tag=None):
         if post.meta_description:
             fe.summary(clean_string(post.meta_description))
         
-        post_content = post.content.replace('{{ email-signup }}', '')
+        post_content = stored_markup(post, blog, post).replace('{{ email-signup }}', '')
 
-        fe.content(clean_string(markdown(post_content, blog, post)), type="html")
+        fe.content(clean_string(excluding_pre(post_content, blog, post)), type="html")
         
         fe.published(post.published_date)
         fe.updated(post.last_modified)
@@ -19,7 +19,7 @@ import boto3
 import requests
 import threading
 
-from blogs.models import Blog, Media
+from blogs.models import Blog, Media, batched_blog_updates
 
 bucket_name = 'vibera'
 
@@ -99,7 +99,9 @@ def upload_image(request, id):
             except Post.DoesNotExist:
                 pass
         
-        file_links = upload_files(blog, request.FILES.getlist('file'), post)
+        # The post is saved once per file, its blog only needs updating once
+        with batched_blog_updates():
+            file_links = upload_files(blog, request.FILES.getlist('file'), post)
 
         return HttpResponse(json.dumps(sorted(file_links)), 200)
 
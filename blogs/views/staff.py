@@ -9,8 +9,9 @@ from django.contrib.auth.models import User
 from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
 
+from blogs.cache import cache_stats
 from blogs.helpers import send_async_mail
-from blogs.models import Blog, PersistentStore, Post
+from blogs.models import Blog, PersistentStore, Post, batched_blog_updates
 from blogs.middleware import request_metrics, redis_client
 
 from statistics import mean
@@ -166,7 +167,9 @@ def import_posts(request):
     if request.method == "POST":
         subdomain = request.POST.get('subdomain')
         csv_file = request.FILES['csv_file']
-        success, message, stats = import_posts_from_csv(subdomain, csv_file)
+        # The blog is updated once at the end rather than after every row
+        with batched_blog_updates():
+            success, message, stats = import_posts_from_csv(subdomain, csv_file)
         error_messages.append(message)
     
     return HttpResponse(error_messages)
@@ -504,7 +507,8 @@ def performance_dashboard(request):
     ))
     
     return render(request, 'staff/performance.html', {
-        'metrics': sorted_metrics
+        'metrics': sorted_metrics,
+        'caches': cache_stats()
     })
 
 def calculate_metrics_summary(measurements):
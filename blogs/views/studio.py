@@ -18,6 +18,7 @@ import string
 from blogs.backup import backup_in_thread
 from blogs.forms import AdvancedSettingsForm, BlogForm, DashboardCustomisationForm, PostTemplateForm
 from blogs.helpers import check_connection, is_protected, salt_and_hash
+from blogs.hosts import normalize_domain
 from blogs.models import Blog, Post, Upvote
 from collections import Counter
 from blogs.subscriptions import get_subscriptions
@@ -837,7 +838,12 @@ def custom_domain_edit(request, id):
     if request.method == "POST":
         custom_domain = request.POST.get("custom-domain", "").lower().strip().replace('https://', '').replace('http://', '')
 
-        if Blog.objects.filter(domain__iexact=custom_domain).exclude(pk=blog.pk).count() == 0:
+        if not custom_domain:
+            blog.domain = ''
+            blog.save()
+        elif Blog.objects.filter(normalized_domain=normalize_domain(custom_domain)).exclude(pk=blog.pk).exists():
+            error_messages.append(f"{custom_domain} is already registered with another blog")
+        else:
             try:
                 validator = URLValidator()
                 validator('http://' + custom_domain)
@@ -846,11 +852,6 @@ def custom_domain_edit(request, id):
             except ValidationError:
                 error_messages.append(f'{custom_domain} is an invalid domain')
                 print("error")
-        elif not custom_domain:
-            blog.domain = ''
-            blog.save()
-        else:
-            error_messages.append(f"{custom_domain} is already registered with another blog")
 
     # If records not set correctly
     if blog.domain and not check_connection(blog):
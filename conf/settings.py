@@ -140,6 +140,39 @@ if os.getenv('DATABASE_URL'):
     db_from_env = dj_database_url.config(conn_max_age=600)
     DATABASES['default'].update(db_from_env)
 
+# Cache
+# Shared between gunicorn workers when Redis is available, otherwise Django's per-process default
+
+if os.getenv('REDISCLOUD_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.getenv('REDISCLOUD_URL'),
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                # A Redis outage should degrade to cache misses, not errors
+                'IGNORE_EXCEPTIONS': True,
+                'SOCKET_CONNECT_TIMEOUT': 1,
+                'SOCKET_TIMEOUT': 1,
+            },
+            'KEY_PREFIX': 'bear',
+        }
+    }
+
+# Render oversized or previously slow markdown in a separate process with a time limit,
+# falling back to plain text so pathological content can't hang a gunicorn worker
+RENDER_SANDBOX = os.getenv('RENDER_SANDBOX') == 'True'
+RENDER_SANDBOX_MIN_SIZE = int(os.getenv('RENDER_SANDBOX_MIN_SIZE', 200000))
+RENDER_TIME_BUDGET = float(os.getenv('RENDER_TIME_BUDGET', 5))
+RENDER_SLOW_THRESHOLD = float(os.getenv('RENDER_SLOW_THRESHOLD', 1))
+# How long content stays on the slow path after rendering slowly or timing out
+RENDER_SLOW_TTL = int(os.getenv('RENDER_SLOW_TTL', 60 * 60 * 24))
+
+# Cache rendered public blog pages at the origin, purged by blog on save. Purges only reach
+# every worker through Redis, without it other workers serve a page until the timeout.
+PAGE_CACHE = os.getenv('PAGE_CACHE') == 'True'
+PAGE_CACHE_TIMEOUT = int(os.getenv('PAGE_CACHE_TIMEOUT', 600))
+
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10 MB
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 